@@ -0,0 +1,603 @@
+"""Offline benchmark for the Music cog.
+
+Runs ``Music`` and ``VoiceState`` against local stand-ins for the gateway
+and the voice client, with a stubbed ``YoutubeDL`` that returns canned
+info dicts after a configurable latency. N simulated guilds issue
+``/play``, ``/skip`` and ``/queue`` workloads, then throughput, latency
+percentiles, track gaps, CPU time and RSS are reported.
+
+Usage:
+
+    python3 benchmark.py --guilds 50 --duration 30
+
+Tracks are rendered to local audio files with ffmpeg when it is
+installed, otherwise synthetic PCM and Opus sources stand in for ffmpeg.
+At ``--volume 100`` the Opus tracks are played as passthrough.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+import discord
+
+import discordBot
+
+
+FRAME_SECONDS = discord.opus.Encoder.FRAME_LENGTH / 1000
+
+
+class FakeYoutubeDL:
+    """Stands in for ``yt_dlp.YoutubeDL``, resolving searches and URLs to canned tracks."""
+
+    def __init__(self, tracks: list, latency: float, jitter: float):
+        self.tracks = tracks
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _wait(self):
+        with self._lock:
+            self.calls += 1
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+
+    def extract_info(self, url: str, download: bool = False, process: bool = True):
+        self._wait()
+        track = self.tracks[int(url.rsplit(' ', 1)[-1].rsplit('/', 1)[-1]) % len(self.tracks)]
+        if not process:
+            return {'webpage_url': track['webpage_url'], 'title': track['title']}
+        return dict(track)
+
+
+class SyntheticPCMAudio(discord.AudioSource):
+    """PCM source producing silence for ``duration`` seconds, used when ffmpeg isn't installed."""
+
+    def __init__(self, source: str, *, before_options: str = None, options: str = None, **kwargs):
+        start = 0.0
+        if before_options and before_options.startswith('-ss '):
+            start = float(before_options.split()[1])
+        self.remaining = max(0, int((SyntheticPCMAudio.durations.get(source, 5) - start) / FRAME_SECONDS))
+
+    durations = {}
+
+    def read(self):
+        if self.remaining <= 0:
+            return b''
+        self.remaining -= 1
+        return bytes(discord.opus.Encoder.FRAME_SIZE)
+
+    def is_opus(self):
+        return False
+
+
+class SyntheticOpusProcess:
+    """Stands in for an ffmpeg process remuxing Opus, used when ffmpeg isn't installed.
+
+    Its stdout is an Ogg stream of silent Opus packets for the track's duration,
+    so the library's own ``FFmpegOpusAudio`` parses and plays it.
+    """
+
+    SILENCE = b'\xf8\xff\xfe'
+
+    def __init__(self, args: list, **kwargs):
+        start = float(args[args.index('-ss') + 1]) if '-ss' in args else 0.0
+        source = args[args.index('-i') + 1]
+        frames = max(0, int((SyntheticPCMAudio.durations.get(source, 5) - start) / FRAME_SECONDS))
+        page = b'OggS' + struct.pack('<xBQIIIB', 0, 0, 0, 0, 0, 1) + bytes([len(self.SILENCE)]) + self.SILENCE
+        self.stdout = io.BytesIO(page * frames)
+        self.pid = 0
+        self.returncode = None
+
+    def kill(self):
+        self.returncode = -9
+
+    def poll(self):
+        return self.returncode
+
+    def communicate(self):
+        return b'', b''
+
+
+class FakeMessage:
+    def __init__(self, channel, content=None, embed=None):
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+
+    async def edit(self, **fields):
+        self.channel.edits += 1
+
+    async def add_reaction(self, emoji):
+        pass
+
+
+class FakeTextChannel:
+    def __init__(self, id: int, guild):
+        self.id = id
+        self.guild = guild
+        self.sent = 0
+        self.edits = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeMessage(self, content, kwargs.get('embed'))
+
+
+class FakeVoiceClient:
+    """Plays sources on a thread at ``speed`` times real time, like ``discord.VoiceClient``."""
+
+    def __init__(self, channel, speed: float, stats: 'Stats'):
+        self.channel = channel
+        self.speed = speed
+        self.stats = stats
+        self.source = None
+        self._connected = True
+        self._paused = threading.Event()
+        self._paused.set()
+        self._stopped = threading.Event()
+        self._thread = None
+        # Stands in for the opus encoder, created like py-cord does when the first source is PCM.
+        self.encoder = None
+
+    def play(self, source, *, after=None):
+        if self.is_playing():
+            raise discord.ClientException('Already playing audio.')
+        if not self.encoder and not source.is_opus():
+            self.encoder = object()
+        self.source = source
+        self._stopped.clear()
+        self.stats.track_started(self.channel.guild.id)
+        self._thread = threading.Thread(target=self._run, args=(source, after), daemon=True)
+        self._thread.start()
+
+    def _run(self, source, after):
+        error = None
+        next_frame = time.perf_counter()
+        try:
+            while not self._stopped.is_set():
+                self._paused.wait()
+                if not source.read():
+                    break
+                if not source.is_opus() and not self.encoder:
+                    raise AttributeError('PCM audio without an encoder')
+                next_frame += FRAME_SECONDS / self.speed
+                delay = next_frame - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        except Exception as e:
+            error = e
+        finally:
+            source.cleanup()
+            self.stats.track_finished(self.channel.guild.id)
+            self._thread = None
+            if after is not None:
+                after(error)
+
+    def is_playing(self):
+        return self._thread is not None and self._paused.is_set()
+
+    def is_paused(self):
+        return self._thread is not None and not self._paused.is_set()
+
+    def is_connected(self):
+        return self._connected
+
+    def pause(self):
+        self._paused.clear()
+
+    def resume(self):
+        self._paused.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._paused.set()
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, *, force: bool = False):
+        self.stop()
+        self._connected = False
+
+
+class FakeVoiceChannel:
+    def __init__(self, id: int, guild, speed: float, stats: 'Stats'):
+        self.id = id
+        self.guild = guild
+        self.members = []
+        self.speed = speed
+        self.stats = stats
+
+    async def connect(self):
+        # Roughly what the voice handshake costs on a real gateway.
+        await asyncio.sleep(0.05)
+        self.guild.voice_client = FakeVoiceClient(self, self.speed, self.stats)
+        return self.guild.voice_client
+
+
+class FakeMember:
+    def __init__(self, id: int, guild, voice_channel):
+        self.id = id
+        self.guild = guild
+        self.bot = False
+        self.mention = '<@{}>'.format(id)
+        self.voice = type('VoiceState', (), {'channel': voice_channel})()
+
+
+class FakeGuild:
+    def __init__(self, id: int, users: int, speed: float, stats: 'Stats'):
+        self.id = id
+        self.voice_client = None
+        self.text_channel = FakeTextChannel(id * 10 + 1, self)
+        self.voice_channel = FakeVoiceChannel(id * 10 + 2, self, speed, stats)
+        self.members = [FakeMember(id * 1000 + i, self, self.voice_channel) for i in range(users)]
+        self.voice_channel.members = list(self.members)
+
+    def get_member(self, id: int):
+        return next((member for member in self.members if member.id == id), None)
+
+    def get_channel(self, id: int):
+        return {self.text_channel.id: self.text_channel, self.voice_channel.id: self.voice_channel}.get(id)
+
+
+class FakeContext:
+    """The parts of ``discord.ApplicationContext`` the Music cog uses."""
+
+    def __init__(self, music: discordBot.Music, guild: FakeGuild, author: FakeMember, command):
+        self.music = music
+        self.guild = guild
+        self.author = author
+        self.channel = guild.text_channel
+        self.command = command
+        self.responses = []
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def respond(self, content=None, **kwargs):
+        self.responses.append(content)
+
+    async def invoke(self, command, *args, **kwargs):
+        return await command.callback(self.music, self, *args, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def typing(self):
+        yield
+
+
+class FakeBot:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.user = type('User', (), {'id': 0, 'name': 'benchmark'})()
+        self.guilds = []
+        self.latency = 0.0
+
+
+class Stats:
+    def __init__(self, voice_states: dict):
+        self.voice_states = voice_states
+        self.latencies = {}
+        self.errors = 0
+        self.gaps = []
+        self.switches = 0
+        self.player_errors = 0
+        self._finished_at = {}
+        self._lock = threading.Lock()
+
+    def command(self, name: str, seconds: float):
+        self.latencies.setdefault(name, []).append(seconds)
+
+    def track_started(self, guild_id: int):
+        with self._lock:
+            finished_at = self._finished_at.pop(guild_id, None)
+            if finished_at is not None:
+                self.gaps.append(time.perf_counter() - finished_at)
+
+    def track_finished(self, guild_id: int):
+        # Only a gap when another song was waiting, an empty queue is just idle time.
+        state = self.voice_states.get(guild_id)
+        if state is None or not (len(state.songs) or state.loop):
+            return
+        with self._lock:
+            self._finished_at[guild_id] = time.perf_counter()
+
+
+def percentiles(samples: list):
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+
+    def at(fraction):
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000
+
+    return {'count': len(samples), 'p50_ms': at(0.5), 'p90_ms': at(0.9), 'p99_ms': at(0.99), 'max_ms': samples[-1] * 1000}
+
+
+def render_tracks(directory: str, count: int, duration: float):
+    """Renders ``count`` sine tracks with ffmpeg, returns their info dicts."""
+
+    ffmpeg = shutil.which('ffmpeg')
+    tracks = []
+    for i in range(count):
+        path = os.path.join(directory, 'track{}.webm'.format(i))
+        if ffmpeg:
+            subprocess.run([ffmpeg, '-loglevel', 'error', '-y', '-f', 'lavfi', '-i',
+                            'sine=frequency={}:duration={}'.format(220 + i * 10, duration),
+                            '-ac', '2', '-ar', '48000', '-c:a', 'libopus', path], check=True)
+        SyntheticPCMAudio.durations[path] = duration
+        tracks.append({
+            'webpage_url': 'https://bench.local/track/{}'.format(i),
+            'title': 'Benchmark track {}'.format(i),
+            'uploader': 'benchmark',
+            'uploader_url': 'https://bench.local',
+            'upload_date': '20240101',
+            'duration': duration,
+            'thumbnail': None,
+            'url': path,
+            'acodec': 'opus',
+        })
+    return tracks, ffmpeg is not None
+
+
+async def run_command(music: discordBot.Music, stats: Stats, guild: FakeGuild, command, **kwargs):
+    ctx = FakeContext(music, guild, random.choice(guild.members), command)
+    started_at = time.perf_counter()
+    try:
+        await music.cog_before_invoke(ctx)
+        if command.name in ('play', 'join'):
+            await music.ensure_voice_state(ctx)
+        await command.callback(music, ctx, **kwargs)
+        await music.cog_after_invoke(ctx)
+    except Exception:
+        stats.errors += 1
+    stats.command(command.name, time.perf_counter() - started_at)
+
+
+async def guild_workload(music: discordBot.Music, stats: Stats, guild: FakeGuild, args, deadline: float):
+    # A few popular tracks make up most requests, like on real servers.
+    weights = [1 / (rank + 1) for rank in range(args.tracks)]
+    while time.perf_counter() < deadline:
+        action = random.choices(('play', 'queue', 'skip'), weights=(args.play_weight, args.queue_weight,
+                                                                    args.skip_weight))[0]
+        if action == 'play':
+            track = random.choices(range(args.tracks), weights=weights)[0]
+            await run_command(music, stats, guild, music._play, search='benchmark track {}'.format(track))
+        elif action == 'queue':
+            await run_command(music, stats, guild, music._queue, page=1)
+        else:
+            await run_command(music, stats, guild, music._skip)
+        await asyncio.sleep(min(random.expovariate(1 / args.think_time), max(0.0, deadline - time.perf_counter())))
+
+
+def rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+async def run(args, worker: int = 0, workers: int = 1, coordinator: tuple = None):
+    """Runs the workload on this process' share of the guilds, returns the raw measurements."""
+
+    random.seed(args.seed + worker)
+    directory = tempfile.mkdtemp(prefix='musicbot-bench-')
+    try:
+        tracks, have_ffmpeg = render_tracks(directory, args.tracks, args.track_duration)
+        if not have_ffmpeg:
+            discord.FFmpegPCMAudio = SyntheticPCMAudio
+            discord.FFmpegAudio._spawn_process = lambda audio, args, **kwargs: SyntheticOpusProcess(args)
+
+        ytdl = FakeYoutubeDL(tracks, args.extract_latency, args.extract_latency / 4)
+        discordBot.YTDLSource.ytdl = discordBot.YTDLSource.ytdl_flat = ytdl
+        # Canned tracks are local files, the network reconnect options don't apply.
+        discordBot.YTDLSource.FFMPEG_OPTIONS = discordBot.YTDLSource.FFMPEG_FILE_OPTIONS
+        discordBot.YTDLSource.index = discordBot.TrackIndex(os.path.join(directory, 'tracks.db'))
+
+        bot = FakeBot(asyncio.get_running_loop())
+        shards = None
+        if coordinator is not None:
+            # The same track files exist in every worker, so replicated cache entries stay playable.
+            shards = discordBot.ShardClient(worker, *coordinator, bot.loop)
+            discordBot.YTDLSource.cache = discordBot.SharedExtractionCache(shards, max_size=0 if args.no_cache else 512)
+        elif args.no_cache:
+            discordBot.YTDLSource.cache = discordBot.ExtractionCache(max_size=0)
+
+        music = discordBot.Music(bot, shards=shards)
+        stats = Stats(music.voice_states)
+        # Gapless switches happen inside the mixer, without a new play() on the voice client.
+        song_switched = discordBot.VoiceState._song_switched
+
+        def count_switch(state):
+            stats.switches += 1
+            song_switched(state)
+
+        discordBot.VoiceState._song_switched = count_switch
+
+        # A player task that dies stops its guild's queue for good, without any command failing.
+        audio_player_task = discordBot.VoiceState.audio_player_task
+
+        async def count_player_error(state):
+            try:
+                await audio_player_task(state)
+            except asyncio.CancelledError:
+                # Only stop() is meant to cancel the player.
+                if not state.stopped:
+                    stats.player_errors += 1
+                raise
+            except Exception:
+                stats.player_errors += 1
+                raise
+
+        discordBot.VoiceState.audio_player_task = count_player_error
+
+        voice_state_init = discordBot.VoiceState.__init__
+
+        def set_volume(state, *args_, **kwargs):
+            voice_state_init(state, *args_, **kwargs)
+            state._volume = args.volume / 100
+
+        discordBot.VoiceState.__init__ = set_volume
+        music.store = discordBot.StateStore(os.path.join(directory, 'voice_states.db'))
+        await music.on_ready()
+
+        guilds = [FakeGuild(i + 1, args.users, args.speed, stats) for i in range(worker, args.guilds, workers)]
+
+        usage_before = resource.getrusage(resource.RUSAGE_SELF)
+        started_at = time.perf_counter()
+        deadline = started_at + args.duration
+        await asyncio.gather(*[guild_workload(music, stats, guild, args, deadline) for guild in guilds])
+        elapsed = time.perf_counter() - started_at
+        usage_after = resource.getrusage(resource.RUSAGE_SELF)
+
+        rss = rss_bytes()
+        queued = sum(len(state.songs) for state in music.voice_states.values())
+        queued_bytes = sum(state.songs.footprint() for state in music.voice_states.values())
+        await asyncio.gather(*[state.stop() for state in music.voice_states.values()])
+        music.voice_states.clear()
+        music.cog_unload()
+
+        return {
+            'ffmpeg': have_ffmpeg,
+            'elapsed': elapsed,
+            'latencies': stats.latencies,
+            'gaps': stats.gaps,
+            'switches': stats.switches,
+            'errors': stats.errors,
+            'player_errors': stats.player_errors,
+            'extractions': ytdl.calls,
+            'cpu': (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime),
+            'rss': rss,
+            'max_rss': usage_after.ru_maxrss * 1024,
+            'queued': queued,
+            'queued_bytes': queued_bytes,
+            'cache': discordBot.YTDLSource.cache.stats(),
+            'coalesced': discordBot.YTDLSource.flights.coalesced,
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run_worker(args, worker: int, workers: int, coordinator: tuple, results):
+    results.put(asyncio.run(run(args, worker, workers, coordinator)))
+
+
+def run_sharded(args):
+    """Runs the workload in ``args.processes`` worker processes behind a real ShardCoordinator."""
+
+    coordinator = discordBot.ShardCoordinator()
+    coordinator.start()
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    processes = [context.Process(target=run_worker, args=(args, worker, args.processes,
+                                                          (coordinator.address, coordinator.authkey), results))
+                 for worker in range(args.processes)]
+    for process in processes:
+        process.start()
+    try:
+        return [results.get() for _ in processes]
+    finally:
+        for process in processes:
+            process.join()
+        coordinator.close()
+
+
+def summarize(args, measurements: list):
+    elapsed = max(measurement['elapsed'] for measurement in measurements)
+    latencies = {}
+    for measurement in measurements:
+        for name, samples in measurement['latencies'].items():
+            latencies.setdefault(name, []).extend(samples)
+    commands = sum(len(samples) for samples in latencies.values())
+    cpu = sum(measurement['cpu'] for measurement in measurements)
+    queued = sum(measurement['queued'] for measurement in measurements)
+    cache = {}
+    for measurement in measurements:
+        for key, value in measurement['cache'].items():
+            if key != 'hit_ratio':
+                cache[key] = cache.get(key, 0) + value
+    lookups = cache.get('hits', 0) + cache.get('misses', 0)
+    cache['hit_ratio'] = cache.get('hits', 0) / lookups if lookups else 0.0
+
+    return {
+        'guilds': args.guilds,
+        'processes': len(measurements),
+        'ffmpeg': measurements[0]['ffmpeg'],
+        'elapsed_s': elapsed,
+        'commands': commands,
+        'commands_per_s': commands / elapsed,
+        'errors': sum(measurement['errors'] for measurement in measurements),
+        'player_errors': sum(measurement['player_errors'] for measurement in measurements),
+        'extractions': sum(measurement['extractions'] for measurement in measurements),
+        'coalesced': sum(measurement['coalesced'] for measurement in measurements),
+        'latency': {name: percentiles(samples) for name, samples in sorted(latencies.items())},
+        'track_gap': percentiles([gap for measurement in measurements for gap in measurement['gaps']]),
+        'gapless_switches': sum(measurement['switches'] for measurement in measurements),
+        'cpu_s': cpu,
+        'cpu_percent': 100 * cpu / elapsed,
+        'rss_mb': sum(measurement['rss'] for measurement in measurements) / 2 ** 20,
+        'max_rss_mb': sum(measurement['max_rss'] for measurement in measurements) / 2 ** 20,
+        'queued_tracks': queued,
+        'bytes_per_queued_track': sum(measurement['queued_bytes'] for measurement in measurements) / queued
+        if queued else None,
+        'extraction_cache': cache,
+    }
+
+
+def main(args):
+    measurements = run_sharded(args) if args.processes > 1 else [asyncio.run(run(args))]
+    report = summarize(args, measurements)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print('{guilds} guilds in {processes} process(es) for {elapsed_s:.1f}s ({0})'.format(
+        'ffmpeg' if report['ffmpeg'] else 'synthetic audio', **report))
+    print('  {commands} commands, {commands_per_s:.1f}/s, {errors} errors, {player_errors} player errors, '
+          '{extractions} extractions '
+          '({coalesced} coalesced)'.format(**report))
+    for name, latency in itertools.chain(report['latency'].items(), [('track gap', report['track_gap'])]):
+        if latency['count']:
+            print('  {:<10} n={count:<6} p50={p50_ms:8.2f}ms p90={p90_ms:8.2f}ms p99={p99_ms:8.2f}ms '
+                  'max={max_ms:8.2f}ms'.format(name, **latency))
+    print('  {gapless_switches} gapless switches between tracks'.format(**report))
+    if report['queued_tracks']:
+        print('  {queued_tracks} tracks left queued, {bytes_per_queued_track:.0f} bytes per track'.format(**report))
+    print('  cpu {cpu_s:.2f}s ({cpu_percent:.1f}%), rss {rss_mb:.1f} MiB, max rss {max_rss_mb:.1f} MiB'.format(
+        **report))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--guilds', type=int, default=20, help='simulated guilds')
+    parser.add_argument('--users', type=int, default=5, help='members in every guild')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds to run the workload for')
+    parser.add_argument('--tracks', type=int, default=50, help='distinct tracks in the catalogue')
+    parser.add_argument('--track-duration', type=float, default=5.0, help='length of every track in seconds')
+    parser.add_argument('--volume', type=int, default=50,
+                        help='player volume in percent, at 100 Opus tracks are played as passthrough')
+    parser.add_argument('--speed', type=float, default=1.0, help='playback speed relative to real time')
+    parser.add_argument('--extract-latency', type=float, default=0.2, help='mean stubbed extraction latency')
+    parser.add_argument('--think-time', type=float, default=1.0, help='mean pause between commands of a guild')
+    parser.add_argument('--play-weight', type=float, default=5.0)
+    parser.add_argument('--queue-weight', type=float, default=3.0)
+    parser.add_argument('--skip-weight', type=float, default=1.0)
+    parser.add_argument('--no-cache', action='store_true', help='disable the extraction cache')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='split the guilds over this many shard processes, connected by a ShardCoordinator')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    main(parser.parse_args())
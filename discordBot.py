@@ -1,16 +1,38 @@
 import asyncio
-import functools
+import bisect
+import collections
+import contextlib
+import concurrent.futures
+import heapq
 import itertools
 import math
+import multiprocessing
+import multiprocessing.connection
 import random
+import re
 import os
+import shutil
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import urllib.parse
 import discord
 from discord.ext import commands
 import sys
 import yt_dlp as youtube_dl
-from async_timeout import timeout
 from dotenv import load_dotenv
-import utils
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from scipy import signal as scipy_signal
+except ImportError:
+    scipy_signal = None
 
 # Silence useless bug reports messages
 youtube_dl.utils.bug_reports_message = lambda: ''
@@ -24,290 +46,3695 @@ class YTDLError(Exception):
     pass
 
 
-class YTDLSource(discord.PCMVolumeTransformer):
-    YTDL_OPTIONS = {
-        'format': 'bestaudio/best',
-        'extractaudio': True,
-        'audioformat': 'mp3',
-        'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
-        'restrictfilenames': True,
-        'noplaylist': True,
-        'nocheckcertificate': True,
-        'ignoreerrors': False,
-        'logtostderr': False,
-        'quiet': True,
-        'no_warnings': True,
-        'default_search': 'auto',
-        'source_address': '0.0.0.0',
-    }
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = collections.defaultdict(float)
 
-    FFMPEG_OPTIONS = {
-        'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-        'options': '-vn',
-    }
+    def inc(self, *labels, amount: float = 1.0):
+        self._values[labels] += amount
 
-    ytdl = youtube_dl.YoutubeDL(YTDL_OPTIONS)
-    
-    def __init__(self, ctx: discord.ApplicationContext, source: discord.FFmpegPCMAudio, *, data: dict, volume: float = 0.5):
-        super().__init__(source, volume)
-	
-        self.requester = ctx.author
-        self.channel = ctx.channel
-        self.data = data
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} counter'.format(self.name)
+        for labels, value in self._values.items():
+            yield '{}{} {}'.format(self.name, MetricsRegistry.format_labels(self.labelnames, labels), value)
 
-        self.uploader = data.get('uploader')
-        self.uploader_url = data.get('uploader_url')
-        date = data.get('upload_date')
-        self.upload_date = date[6:8] + '.' + date[4:6] + '.' + date[0:4]
-        self.title = data.get('title')
-        self.thumbnail = data.get('thumbnail')
-        self.description = data.get('description')
-        self.duration = self.parse_duration(int(data.get('duration')))
-        self.tags = data.get('tags')
-        self.url = data.get('webpage_url')
-        self.views = data.get('view_count')
-        self.likes = data.get('like_count')
-        self.dislikes = data.get('dislike_count')
-        self.stream_url = data.get('url')
 
-    def __str__(self):
-        return '**{0.title}** by **{0.uploader}**'.format(self)
+class Histogram:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
 
-    @classmethod
-    async def create_source(cls, ctx: discord.ApplicationContext, search: str, *, loop: asyncio.BaseEventLoop = None):
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # Per label set: [count per bucket (+Inf last), sum].
+        self._values = {}
+
+    def observe(self, value: float, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def time(self, *labels):
+        """Context manager observing the duration of its block."""
+
+        return _Timer(self, labels)
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} histogram'.format(self.name)
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(self.name, MetricsRegistry.format_labels(
+                    self.labelnames + ('le',), labels + ('+Inf' if bound == float('inf') else repr(bound),)),
+                    cumulative)
+            yield '{}_sum{} {}'.format(self.name, MetricsRegistry.format_labels(self.labelnames, labels), total)
+            yield '{}_count{} {}'.format(self.name, MetricsRegistry.format_labels(self.labelnames, labels),
+                                         cumulative)
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started_at')
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started_at, *self.labels)
+
+
+class Gauge:
+    """Gauge computed by ``function`` at scrape time, returning a value or ``{labels: value}``."""
+
+    def __init__(self, name: str, documentation: str, function, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.labelnames = labelnames
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} gauge'.format(self.name)
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            yield '{}{} {}'.format(self.name, MetricsRegistry.format_labels(self.labelnames, labels), value)
+
+
+class MetricsRegistry:
+    """Counters and histograms in the Prometheus text format, served over local HTTP.
+
+    Recording a sample only bumps a few numbers in memory, gauges and the
+    text output are only computed when the endpoint is scraped.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self.server = None
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = Histogram.BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, function, labelnames: tuple = ()):
+        return self._register(Gauge(name, documentation, function, labelnames))
+
+    def _register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    @staticmethod
+    def format_labels(names: tuple, values: tuple):
+        if not names:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                              for name, value in zip(names, values)) + '}'
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    async def start_server(self, host: str = '127.0.0.1', port: int = 9090):
+        if self.server is None:
+            self.server = await asyncio.start_server(self._handle, host, port)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+
+            if request.split()[1:2] == [b'/metrics']:
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b''
+            writer.write('HTTP/1.1 {}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {}\r\n'
+                         'Connection: close\r\n\r\n'.format(status, len(body)).encode() + body)
+            await writer.drain()
+        except (ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+
+metrics = MetricsRegistry()
+EXTRACTION_SECONDS = metrics.histogram('musicbot_extraction_seconds',
+                                       'Time spent in yt-dlp extractions, by phase.', ('phase',))
+FFMPEG_SPAWN_SECONDS = metrics.histogram('musicbot_ffmpeg_spawn_seconds', 'Time spent spawning ffmpeg subprocesses.')
+FIRST_AUDIO_SECONDS = metrics.histogram('musicbot_enqueue_to_first_audio_seconds',
+                                        'Time from enqueueing a song until it starts playing.',
+                                        buckets=Histogram.BUCKETS + (300.0, 900.0, 3600.0))
+TRACK_GAP_SECONDS = metrics.histogram('musicbot_track_gap_seconds',
+                                      'Silence between the end of a song and the start of the next one.')
+COMMAND_SECONDS = metrics.histogram('musicbot_command_seconds', 'Slash command latency.', ('command',))
+COMMAND_ERRORS = metrics.counter('musicbot_command_errors_total', 'Slash commands that failed.', ('command',))
+
+
+class ExtractionCache:
+    """Shared, size-bounded LRU cache of resolved yt-dlp info dicts.
+
+    Entries are keyed by the normalized search string and by the
+    ``webpage_url`` they resolved to, so both a repeated query and a
+    direct link to an already known track skip extraction. An entry
+    goes stale shortly before its signed stream URL expires, or after
+    ``ttl`` seconds when the URL carries no expiry.
+    """
+
+    def __init__(self, max_size: int = 512, ttl: float = 3600, expiry_margin: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.expiry_margin = expiry_margin
+        self._entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def normalize(search: str):
+        search = ' '.join(search.split())
+        # URLs are case sensitive (video ids), free-text searches are not.
+        if '://' in search:
+            return search
+        return search.lower()
+
+    @staticmethod
+    def stream_expiry(info: dict):
+        """Returns the unix time at which the signed stream URL of ``info`` expires, if known."""
+
+        url = info.get('url')
+        if not url:
+            return None
+
+        parsed = urllib.parse.urlparse(url)
+        expire = urllib.parse.parse_qs(parsed.query).get('expire')
+        if expire:
+            value = expire[0]
+        else:
+            # Manifest URLs carry their parameters in the path instead: .../expire/1700000000/...
+            parts = parsed.path.split('/')
+            try:
+                value = parts[parts.index('expire') + 1]
+            except (ValueError, IndexError):
+                return None
+
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+    def get(self, key: str):
+        key = self.normalize(key)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        info, expires_at = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return info
+
+    def put(self, info: dict, *keys: str):
+        expires_at = self.stream_expiry(info)
+        if expires_at is None:
+            expires_at = time.time() + self.ttl
+        else:
+            expires_at = min(expires_at - self.expiry_margin, time.time() + self.ttl)
+
+        for key in set(self.normalize(key) for key in keys if key):
+            self._entries[key] = (info, expires_at)
+            self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, *keys: str):
+        for key in keys:
+            self._entries.pop(self.normalize(key), None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class SharedExtractionCache(ExtractionCache):
+    """Extraction cache of a shard process, replicated to the other shard processes.
+
+    Every entry put into the cache is forwarded through the
+    :class:`ShardCoordinator`, and entries the other shards resolved
+    arrive through :meth:`replicate`. Lookups stay local.
+    """
+
+    def __init__(self, shards: 'ShardClient', **kwargs):
+        super().__init__(**kwargs)
+        self.shards = shards
+        self.replicated = 0
+
+    def put(self, info: dict, *keys: str):
+        super().put(info, *keys)
+        self.shards.send('cache', info, keys)
+
+    def replicate(self, info: dict, keys: tuple):
+        super().put(info, *keys)
+        self.replicated += 1
+
+    def stats(self):
+        stats = super().stats()
+        stats['replicated'] = self.replicated
+        return stats
+
+
+class SQLiteStore:
+    """Base of the SQLite databases, keeps their I/O off the event loop.
+
+    The database is only opened on first use, to keep it off the login
+    path. SQLite connections belong to the thread that opened them, so all
+    queries run on one worker thread, in the order they were issued. Every
+    shard process shares the database, an operation that finds it locked
+    for longer than ``BUSY_TIMEOUT`` is logged and skipped.
+    """
+
+    SCHEMA = ''
+    # What the database holds, for error messages.
+    DESCRIPTION = 'database'
+    BUSY_TIMEOUT = 2
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = None
+        self._closed = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+
+    @property
+    def db(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=self.BUSY_TIMEOUT)
+            try:
+                db.executescript(self.SCHEMA)
+            except sqlite3.OperationalError:
+                # Opened again on the next access, once the database isn't locked any more.
+                db.close()
+                raise
+            self._db = db
+        return self._db
+
+    def _submit(self, func, *args):
+        """Runs ``func`` on the database thread, without waiting for it."""
+
+        if not self._closed:
+            self._executor.submit(self._run, func, *args)
+
+    async def _call(self, func, *args, loop: asyncio.BaseEventLoop = None):
+        """Runs ``func`` on the database thread and returns its result, ``None`` if it failed."""
+
+        if self._closed:
+            return None
+        loop = loop or asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self._run, func, *args)
+
+    def _run(self, func, *args):
+        try:
+            return func(*args)
+        except sqlite3.OperationalError as e:
+            print('Error occured while accessing the {} {}'.format(self.DESCRIPTION, e))
+            return None
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        # Pending writes still run before the worker thread exits.
+        self._executor.submit(self._close)
+        self._executor.shutdown(wait=False)
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class TrackIndex(SQLiteStore):
+    """Persistent ``webpage_url`` -> metadata index, shared across restarts.
+
+    Remembers which track every search string resolved to, so a warm
+    lookup skips the flat ``process=False`` search phase. The database is
+    compacted down to ``max_tracks`` least recently used tracks. An index
+    that stays locked is skipped, and the track extracted as if it was
+    never seen.
+    """
+
+    SCHEMA = '''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA foreign_keys=ON;
+        CREATE TABLE IF NOT EXISTS tracks (
+            webpage_url TEXT PRIMARY KEY,
+            title TEXT,
+            uploader TEXT,
+            uploader_url TEXT,
+            duration INTEGER,
+            thumbnail TEXT,
+            last_used REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS searches (
+            query TEXT PRIMARY KEY,
+            webpage_url TEXT NOT NULL REFERENCES tracks(webpage_url) ON DELETE CASCADE
+        );
+        CREATE INDEX IF NOT EXISTS searches_webpage_url ON searches(webpage_url);
+        CREATE INDEX IF NOT EXISTS tracks_last_used ON tracks(last_used);
+    '''
+    DESCRIPTION = 'track index'
+    COMPACT_EVERY = 500
+
+    def __init__(self, path: str = 'tracks.db', max_tracks: int = 20000):
+        super().__init__(path)
+        self.max_tracks = max_tracks
+        self._writes = 0
+
+    async def lookup(self, search: str, *, loop: asyncio.BaseEventLoop = None):
+        """Returns the ``webpage_url`` a search string resolved to before, if any."""
+
+        return await self._call(self._lookup, search, loop=loop)
+
+    def store(self, info: dict, *searches: str):
+        """Remembers that ``searches`` resolved to ``info``, without waiting for the write."""
+
+        if info.get('webpage_url'):
+            self._submit(self._store, info, *searches)
+
+    def _lookup(self, search: str):
+        row = self.db.execute('SELECT webpage_url FROM searches WHERE query = ?',
+                              (ExtractionCache.normalize(search),)).fetchone()
+        return row[0] if row else None
+
+    def _store(self, info: dict, *searches: str):
+        webpage_url = info['webpage_url']
+        with self.db:
+            self.db.execute('INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?) '
+                            'ON CONFLICT(webpage_url) DO UPDATE SET title = excluded.title, '
+                            'uploader = excluded.uploader, uploader_url = excluded.uploader_url, '
+                            'duration = excluded.duration, thumbnail = excluded.thumbnail, '
+                            'last_used = excluded.last_used',
+                            (webpage_url, info.get('title'), info.get('uploader'), info.get('uploader_url'),
+                             info.get('duration'), info.get('thumbnail'), time.time()))
+            self.db.executemany('INSERT OR REPLACE INTO searches VALUES (?, ?)',
+                                [(ExtractionCache.normalize(search), webpage_url)
+                                 for search in set(searches) if search and search != webpage_url])
+
+        self._writes += 1
+        if self._writes % self.COMPACT_EVERY == 0:
+            self._compact()
+
+    def _compact(self):
+        """Drops the least recently used tracks, and their searches, beyond ``max_tracks``."""
+
+        with self.db:
+            removed = self.db.execute('DELETE FROM tracks WHERE webpage_url IN ('
+                                      'SELECT webpage_url FROM tracks ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                                      (self.max_tracks,)).rowcount
+        if removed:
+            self.db.execute('VACUUM')
+        return removed
+
+
+def _fetch_audio(url: str, options: dict):
+    """Executor target for :class:`AudioCache`, downloads the audio of one track as is."""
+
+    with youtube_dl.YoutubeDL(options) as ydl:
+        info = ydl.extract_info(url, download=True)
+        return ydl.prepare_filename(info)
+
+
+class AudioCache:
+    """Optional on-disk tier for hot tracks, bounded to ``max_bytes``.
+
+    Tracks played at least ``min_plays`` times are fetched once into
+    ``directory``, preferring an Opus stream so no transcode is needed, and
+    are then played from disk instead of being streamed again. When the
+    budget is exceeded the least frequently played files are evicted,
+    least recently used first. A ``max_bytes`` of 0 disables the cache.
+    """
+
+    FORMAT = 'bestaudio[acodec=opus]/bestaudio'
+    # Longer tracks and live streams are never cached.
+    MAX_DURATION = 20 * 60
+
+    def __init__(self, directory: str = 'audio_cache', max_bytes: int = 0, *, min_plays: int = 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='audio-cache')
+        self._files = None
+        self._plays = collections.Counter()
+        self._fetching = set()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def key(webpage_url: str):
+        return hashlib.sha1(webpage_url.encode()).hexdigest()
+
+    @staticmethod
+    def is_opus(path: str):
+        # Files are named <key>.<acodec>.<ext>.
+        parts = os.path.basename(path).split('.')
+        return len(parts) == 3 and parts[1] == 'opus'
+
+    @property
+    def files(self):
+        """Cached files by key, as ``[path, size, last_used]``; scanned from disk on first use."""
+
+        if self._files is None:
+            self._files = {}
+            os.makedirs(self.directory, exist_ok=True)
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and not entry.name.endswith('.part'):
+                    stat = entry.stat()
+                    self._files[entry.name.split('.', 1)[0]] = [entry.path, stat.st_size, stat.st_mtime]
+                    self.size += stat.st_size
+        return self._files
+
+    def lookup(self, webpage_url: str):
+        """Returns the path of the cached audio of ``webpage_url``, if any."""
+
+        if not self.max_bytes or not webpage_url:
+            return None
+
+        entry = self.files.get(self.key(webpage_url))
+        if entry is None or not os.path.exists(entry[0]):
+            self.misses += 1
+            return None
+
+        entry[2] = time.time()
+        # Recency survives restarts through the file's mtime.
+        os.utime(entry[0])
+        self.hits += 1
+        self.bytes_saved += entry[1]
+        return entry[0]
+
+    def record_play(self, info: dict, *, loop: asyncio.BaseEventLoop = None):
+        """Counts a play of ``info`` and starts fetching it once it got hot enough."""
+
+        webpage_url = info.get('webpage_url')
+        if not self.max_bytes or not webpage_url:
+            return
+
+        key = self.key(webpage_url)
+        self._plays[key] += 1
+        if (self._plays[key] < self.min_plays or key in self.files or key in self._fetching
+                or info.get('is_live') or (info.get('duration') or 0) > self.MAX_DURATION):
+            return
+
+        self._fetching.add(key)
         loop = loop or asyncio.get_event_loop()
+        loop.create_task(self._fetch(key, webpage_url, loop))
+
+    async def _fetch(self, key: str, webpage_url: str, loop: asyncio.BaseEventLoop):
+        options = dict(YTDLSource.YTDL_OPTIONS, format=self.FORMAT,
+                       outtmpl=os.path.join(self.directory, key + '.%(acodec)s.%(ext)s'))
+        try:
+            path = await loop.run_in_executor(self._executor, _fetch_audio, webpage_url, options)
+        except youtube_dl.utils.DownloadError:
+            return
+        finally:
+            self._fetching.discard(key)
+
+        size = os.path.getsize(path)
+        self.files[key] = [path, size, time.time()]
+        self.size += size
+        self.evict()
+
+    def evict(self):
+        """Removes the least valuable files until the cache fits into ``max_bytes``."""
+
+        if self.size <= self.max_bytes:
+            return
+
+        for key in sorted(self.files, key=lambda key: (self._plays[key], self.files[key][2])):
+            path, size, _ = self.files.pop(key)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.size -= size
+            if self.size <= self.max_bytes:
+                break
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'files': len(self._files or ()),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'bytes_saved': self.bytes_saved,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+class SharedStream:
+    """One ffmpeg decode of a track, fanned out to any number of readers.
+
+    A producer thread decodes PCM frames into a ring buffer of ``capacity``
+    frames and never runs more than that ahead of the fastest reader.
+    Every reader keeps its own cursor. One that falls behind the oldest
+    buffered frame (e.g. while paused) is told so instead of skipping
+    audio, and continues on a decode of its own.
+    """
+
+    def __init__(self, hub: 'SharedStreamHub', key: str, source: discord.FFmpegPCMAudio, capacity: int):
+        self.hub = hub
+        self.key = key
+        self.capacity = capacity
+        self._source = source
+        self._frames = [None] * capacity
+        self._cursors = {}
+        self._cond = threading.Condition()
+        self.head = 0
+        self.done = False
+
+        self._thread = threading.Thread(target=self._produce, name='shared-stream', daemon=True)
+        self._thread.start()
+
+    @property
+    def base(self):
+        """Index of the oldest frame still in the buffer."""
+
+        return max(0, self.head - self.capacity)
+
+    def _produce(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self.done and self.head - max(self._cursors.values(), default=0) >= self.capacity:
+                        self._cond.wait(0.1)
+                    if self.done:
+                        break
+
+                data = self._source.read()
+                with self._cond:
+                    if not data:
+                        break
+                    self._frames[self.head % self.capacity] = data
+                    self.head += 1
+                    self._cond.notify_all()
+        finally:
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+            self._source.cleanup()
+            self.hub.finished(self)
 
-        partial = functools.partial(cls.ytdl.extract_info, search, download=False, process=False)
-        data = await loop.run_in_executor(None, partial)
+    def attach(self, reader: 'SharedStreamReader'):
+        """Adds a reader at the first frame, if it is still buffered."""
+
+        with self._cond:
+            if self.done or self.base > 0:
+                return False
+            self._cursors[id(reader)] = 0
+            return True
+
+    def detach(self, reader: 'SharedStreamReader'):
+        """Removes a reader, returns the number of frames it has read."""
+
+        with self._cond:
+            cursor = self._cursors.pop(id(reader), 0)
+            if not self._cursors:
+                # Nobody is listening anymore, stop decoding.
+                self.done = True
+            self._cond.notify_all()
+            return cursor
+
+    def read(self, reader: 'SharedStreamReader'):
+        """Returns the reader's next frame, or ``None`` if it fell behind the buffer."""
+
+        with self._cond:
+            cursor = self._cursors[id(reader)]
+            if cursor < self.base:
+                return None
+            while cursor >= self.head and not self.done:
+                self._cond.wait(0.5)
+            if cursor >= self.head:
+                return b''
+
+            data = self._frames[cursor % self.capacity]
+            self._cursors[id(reader)] = cursor + 1
+            self._cond.notify_all()
+            return data
+
+
+class SharedStreamReader(discord.AudioSource):
+    """PCM source reading one guild's position of a :class:`SharedStream`.
+
+    The stream is only joined on the first read, so a prefetched song
+    doesn't hold on to a stream it would later have to skip into. A reader
+    that falls behind the stream's buffer leaves it and spawns its own
+    ffmpeg process, seeking to where it stopped.
+    """
+
+    def __init__(self, hub: 'SharedStreamHub', key: str, stream_url: str, ffmpeg_options: dict):
+        self.hub = hub
+        self.key = key
+        self.stream_url = stream_url
+        self.ffmpeg_options = ffmpeg_options
+        self._stream = None
+        self._source = None
+
+    def read(self):
+        if self._source is not None:
+            return self._source.read()
+
+        if self._stream is None:
+            self._stream = self.hub.join(self)
+        data = self._stream.read(self)
+        if data is not None:
+            return data
+
+        frames = self._stream.detach(self)
+        self._stream = None
+        start = frames * discord.opus.Encoder.FRAME_LENGTH / 1000
+        options = dict(self.ffmpeg_options, before_options='-ss {:.2f} {}'.format(
+            start, self.ffmpeg_options.get('before_options', '')).strip())
+        self._source = discord.FFmpegPCMAudio(self.stream_url, **options)
+        self.hub.detached += 1
+        return self._source.read()
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        if self._stream is not None:
+            self._stream.detach(self)
+            self._stream = None
+        if self._source is not None:
+            self._source.cleanup()
+            self._source = None
+
+
+class SharedStreamHub:
+    """Shares one decode per ``webpage_url`` between guilds playing the same track at the same time.
+
+    A guild joins a running stream while its first frame is still
+    buffered, i.e. within the first ``capacity`` frames (15 seconds) of
+    the decode. Otherwise a new decode is started for it and for the
+    guilds that follow. Volume is still applied per guild on top of the
+    shared PCM frames.
+
+    Every reader still holds its own ffmpeg slot, as it needs a decode of
+    its own once it falls more than ``capacity`` frames behind the
+    fastest reader.
+    """
+
+    # Frames of 20 ms kept per stream, 15 seconds of audio.
+    CAPACITY = 750
+
+    def __init__(self, enabled: bool = False, *, capacity: int = CAPACITY):
+        self.enabled = enabled
+        self.capacity = capacity
+        self._streams = {}
+        self._lock = threading.Lock()
+
+        self.started = 0
+        self.joined = 0
+        self.detached = 0
+
+    def reader(self, key: str, stream_url: str, ffmpeg_options: dict):
+        return SharedStreamReader(self, key, stream_url, ffmpeg_options)
+
+    def join(self, reader: SharedStreamReader):
+        with self._lock:
+            stream = self._streams.get(reader.key)
+            if stream is not None and stream.attach(reader):
+                self.joined += 1
+                return stream
+
+            stream = SharedStream(self, reader.key, discord.FFmpegPCMAudio(reader.stream_url, **reader.ffmpeg_options),
+                                  self.capacity)
+            stream.attach(reader)
+            self._streams[reader.key] = stream
+            self.started += 1
+            return stream
+
+    def finished(self, stream: SharedStream):
+        with self._lock:
+            if self._streams.get(stream.key) is stream:
+                del self._streams[stream.key]
+
+    def stats(self):
+        return {
+            'streams': len(self._streams),
+            'started': self.started,
+            'joined': self.joined,
+            'detached': self.detached,
+        }
+
+
+class FFmpegSlot:
+    __slots__ = ('limiter', 'released')
+
+    def __init__(self, limiter: 'FFmpegLimiter'):
+        self.limiter = limiter
+        self.released = False
+
+    def release(self):
+        # Sources are cleaned up from the voice client's player thread as well.
+        if not self.released:
+            self.released = True
+            # Players still winding down when the bot shuts down have nothing left to release to.
+            if not self.limiter.loop.is_closed():
+                self.limiter.loop.call_soon_threadsafe(self.limiter._release)
+
+
+class FFmpegLimiter:
+    """Global admission control for ffmpeg subprocesses.
+
+    Every source holds a slot from spawning its ffmpeg process until it is
+    cleaned up. Songs about to play wait for a slot, while prefetching is
+    skipped once the running processes get close to ``max_processes``.
+    A ``max_processes`` of 0 means no limit.
+    """
+
+    # Share of the slots prefetching may use, the rest is kept for songs that are about to play.
+    PREFETCH_SHARE = 0.9
+
+    def __init__(self, max_processes: int = 0):
+        self.max_processes = max_processes
+        self.loop = None
+        self._semaphore = None
+
+        self.active = 0
+        self.waiting = 0
+
+    async def acquire(self, loop: asyncio.BaseEventLoop):
+        self.loop = loop
+        if self.max_processes:
+            if self._semaphore is None:
+                self._semaphore = asyncio.Semaphore(self.max_processes)
+
+            self.waiting += 1
+            try:
+                await self._semaphore.acquire()
+            finally:
+                self.waiting -= 1
+
+        self.active += 1
+        return FFmpegSlot(self)
+
+    def _release(self):
+        self.active -= 1
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    def can_prefetch(self):
+        return not self.max_processes or self.active + self.waiting < self.max_processes * self.PREFETCH_SHARE
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'waiting': self.waiting,
+            'max_processes': self.max_processes,
+        }
+
+
+def _extract_info(url: str, process: bool, flat: bool, submitted_at: float):
+    """Executor target for :class:`ExtractionExecutor`.
+
+    Returns the time the extraction started alongside the info dict so the
+    caller can account for time spent waiting in the pool.
+    """
+
+    started_at = time.time()
+    ytdl = YTDLSource.ytdl_flat if flat else YTDLSource.ytdl
+    data = ytdl.extract_info(url, download=False, process=process)
+    if data is not None and 'entries' in data and not isinstance(data['entries'], list):
+        # Lazy entry generators can't cross a process boundary, only the first match is used anyway.
+        data['entries'] = list(itertools.islice((entry for entry in data['entries'] if entry), 1))
+    return started_at, data
+
+
+class ExtractionExecutor:
+    """Dedicated, bounded pool for blocking yt-dlp extractions.
+
+    Extractions no longer share the loop's default executor. At most
+    ``per_guild_limit`` extractions of one guild are in flight at a time,
+    so a guild spamming ``/play`` can only occupy a few of the
+    ``max_workers`` slots. With ``use_processes`` the extractions run in a
+    process pool and extractor parsing no longer competes for the GIL.
+    """
+
+    def __init__(self, max_workers: int = 4, per_guild_limit: int = 2, *, use_processes: bool = False):
+        self.max_workers = max_workers
+        self.per_guild_limit = per_guild_limit
+        self.use_processes = use_processes
+        self._executor = None
+        self._guild_slots = {}
+
+        # Requests waiting for their guild's slot, and requests handed to the pool.
+        self.waiting = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.use_processes:
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers,
+                                                                       thread_name_prefix='ytdl')
+        return self._executor
+
+    @property
+    def queue_depth(self):
+        """Number of extractions that were requested but haven't started running yet."""
+
+        return self.waiting + max(0, self.in_flight - self.max_workers)
+
+    async def extract_info(self, url: str, *, process: bool = True, flat: bool = False, guild_id: int = None,
+                           loop: asyncio.BaseEventLoop = None):
+        loop = loop or asyncio.get_event_loop()
+
+        slot = self._guild_slots.get(guild_id)
+        if slot is None:
+            slot = self._guild_slots[guild_id] = [asyncio.Semaphore(self.per_guild_limit), 0]
+        slot[1] += 1
+
+        submitted_at = time.time()
+        self.waiting += 1
+        try:
+            await slot[0].acquire()
+        except BaseException:
+            self.waiting -= 1
+            self._release(guild_id, slot, acquired=False)
+            raise
+        self.waiting -= 1
+        self.in_flight += 1
+
+        def finished(job):
+            # A job that already started can't be cancelled, its slot is only free once it is done.
+            self.in_flight -= 1
+            self._release(guild_id, slot, acquired=True)
+
+        job = self.executor.submit(_extract_info, url, process, flat, submitted_at)
+        job.add_done_callback(lambda job: loop.is_closed() or loop.call_soon_threadsafe(finished, job))
+        # Cancelling the wrapper cancels the job too, as long as it is still waiting for a worker.
+        started_at, data = await asyncio.wrap_future(job, loop=loop)
+
+        waited = max(0.0, started_at - submitted_at)
+        self.completed += 1
+        self.wait_time_total += waited
+        self.wait_time_max = max(self.wait_time_max, waited)
+        return data
+
+    def _release(self, guild_id: int, slot: list, *, acquired: bool):
+        if acquired:
+            slot[0].release()
+        slot[1] -= 1
+        if not slot[1]:
+            del self._guild_slots[guild_id]
+
+    def stats(self):
+        return {
+            'workers': self.max_workers,
+            'backend': 'process' if self.use_processes else 'thread',
+            'queue_depth': self.queue_depth,
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'wait_time_avg': self.wait_time_total / self.completed if self.completed else 0.0,
+            'wait_time_max': self.wait_time_max,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one.
+
+    The first caller for a key starts the work in a task, callers arriving
+    while it runs await the same task. Every caller gets its result or its
+    exception. A cancelled caller only stops waiting, the work itself is
+    cancelled once none of its callers is left.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+        self.started = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def run(self, key, factory, *, loop: asyncio.BaseEventLoop = None):
+        """Returns the result of ``factory()``, or of the call for ``key`` already in flight."""
+
+        call = self._calls.get(key)
+        if call is None:
+            loop = loop or asyncio.get_event_loop()
+            call = self._calls[key] = [loop.create_task(factory()), 0]
+            call[0].add_done_callback(lambda task: self._calls.get(key) is call and self._calls.pop(key))
+            self.started += 1
+        else:
+            self.coalesced += 1
+
+        task = call[0]
+        call[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            call[1] -= 1
+            if not call[1] and not task.done():
+                # Callers arriving from now on start over instead of joining the cancelled task.
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+                task.cancel()
+
+    def stats(self):
+        return {
+            'in_flight': len(self._calls),
+            'started': self.started,
+            'coalesced': self.coalesced,
+        }
+
+
+class SearchSuggestions:
+    """Autocomplete for free-text searches, backed by flat yt-dlp searches.
+
+    Results are cached for ``ttl`` seconds by normalized query and are
+    shared by all guilds. A search only runs once the user stopped typing
+    for ``debounce`` seconds, and a newer keystroke cancels the user's
+    search still in flight. Until a search completes, the results of the
+    longest cached prefix of the query are filtered locally instead.
+    """
+
+    MIN_LENGTH = 3
+    # Discord caps choice names and values at 100 characters, and answers at 25 choices.
+    MAX_LENGTH = 100
+    MAX_CHOICES = 25
+
+    def __init__(self, results: int = 10, *, ttl: float = 120, debounce: float = 0.4, timeout: float = 2.5,
+                 max_size: int = 1024, workers: int = 2):
+        self.results = results
+        # Searches run in their own small pool, so typing can't hold up the extractions of /play.
+        self.executor = ExtractionExecutor(workers, per_guild_limit=1)
+        self.ttl = ttl
+        self.debounce = debounce
+        # Discord drops autocomplete answers after 3 seconds.
+        self.timeout = timeout
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._pending = {}
+
+        self.hits = 0
+        self.prefix_hits = 0
+        self.searches = 0
+        self.cancelled = 0
+
+    @classmethod
+    def choice(cls, entry: dict):
+        """Turns a flat search entry into an option choice carrying its ``webpage_url``, if it fits."""
+
+        url = entry.get('webpage_url') or entry.get('url')
+        if not url or '://' not in url or len(url) > cls.MAX_LENGTH:
+            return None
+
+        name = entry.get('title') or url
+        uploader = entry.get('uploader') or entry.get('channel')
+        if uploader:
+            name = '{} - {}'.format(name, uploader)
+        if entry.get('duration'):
+            suffix = ' ({})'.format(NowPlaying.format_time(entry['duration']))
+        else:
+            suffix = ''
+        if len(name) + len(suffix) > cls.MAX_LENGTH:
+            name = name[:cls.MAX_LENGTH - len(suffix) - 1] + '…'
+        return discord.OptionChoice(name + suffix, url)
+
+    def _get(self, query: str):
+        entry = self._entries.get(query)
+        if entry is None:
+            return None
+
+        choices, expires_at = entry
+        if expires_at <= time.time():
+            del self._entries[query]
+            return None
+
+        self._entries.move_to_end(query)
+        return choices
+
+    def _put(self, query: str, choices: list):
+        self._entries[query] = (choices, time.time() + self.ttl)
+        self._entries.move_to_end(query)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _prefix(self, query: str):
+        """Filters the results of the longest cached prefix of ``query`` by its words."""
+
+        for end in range(len(query) - 1, self.MIN_LENGTH - 1, -1):
+            choices = self._get(query[:end])
+            if choices is not None:
+                self.prefix_hits += 1
+                words = query.split()
+                return [choice for choice in choices if all(word in choice.name.lower() for word in words)]
+        return []
+
+    async def _search(self, query: str, guild_id: int, loop: asyncio.BaseEventLoop):
+        await asyncio.sleep(self.debounce)
+
+        self.searches += 1
+        try:
+            with EXTRACTION_SECONDS.time('suggest'):
+                data = await self.executor.extract_info('ytsearch{}:{}'.format(self.results, query), flat=True,
+                                                        guild_id=guild_id, loop=loop)
+        except Exception as e:
+            print('Error occured while searching for suggestions: {}'.format(e))
+            return []
+
+        choices = []
+        for entry in (data or {}).get('entries') or ():
+            choice = self.choice(entry) if entry else None
+            if choice is not None:
+                choices.append(choice)
+        self._put(query, choices[:self.MAX_CHOICES])
+        return choices[:self.MAX_CHOICES]
+
+    async def suggest(self, query: str, *, user_id: int, guild_id: int = None, loop: asyncio.BaseEventLoop = None):
+        """Returns the option choices for what ``user_id`` typed so far."""
+
+        loop = loop or asyncio.get_event_loop()
+        query = ExtractionCache.normalize(query or '')
+        # Links are played as they are.
+        if len(query) < self.MIN_LENGTH or '://' in query:
+            return []
+
+        choices = self._get(query)
+        if choices is not None:
+            self.hits += 1
+            return choices
+
+        previous = self._pending.pop(user_id, None)
+        if previous is not None and not previous.done():
+            previous.cancel()
+            self.cancelled += 1
+
+        task = self._pending[user_id] = loop.create_task(self._search(query, guild_id, loop))
+        task.add_done_callback(lambda task: self._pending.get(user_id) is task and self._pending.pop(user_id))
+        # The search keeps running on timeout and fills the cache for the next keystroke.
+        await asyncio.wait((task,), timeout=self.timeout)
+
+        if task.done() and not task.cancelled():
+            return task.result()
+        return self._prefix(query)
+
+    def clear(self):
+        for task in self._pending.values():
+            task.cancel()
+        self._pending.clear()
+        self._entries.clear()
+
+    def shutdown(self):
+        self.clear()
+        self.executor.shutdown()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'prefix_hits': self.prefix_hits,
+            'searches': self.searches,
+            'cancelled': self.cancelled,
+            'queue_depth': self.executor.queue_depth,
+        }
+
+
+class AudioProcessor(discord.PCMVolumeTransformer):
+    """Audio stage for a PCM source: volume, loudness normalization and bass boost.
+
+    Frames are processed with NumPy on buffers allocated once per source.
+    Volume changes are ramped over a few frames instead of jumping, and
+    normalization scales towards ``TARGET_RMS`` using a slow moving average
+    of the track's loudness. The bass boost is a low-shelf biquad and
+    needs SciPy. Without NumPy this behaves like ``PCMVolumeTransformer``.
+    """
+
+    SAMPLES = discord.opus.Encoder.SAMPLES_PER_FRAME
+    CHANNELS = discord.opus.Encoder.CHANNELS
+    # Roughly -20 dBFS, leaves headroom for loud tracks.
+    TARGET_RMS = 3300.0
+    # Weight of every frame in the loudness average, about two seconds of memory.
+    LOUDNESS_SMOOTHING = 0.01
+    MIN_NORMALIZE_GAIN = 0.25
+    MAX_NORMALIZE_GAIN = 4.0
+    BASS_BOOST_FREQUENCY = 120.0
+
+    def __init__(self, original: discord.AudioSource, volume: float = 1.0, *, normalize: bool = False,
+                 bass_boost: float = 0.0):
+        super().__init__(original, volume)
+        # 20 ms frames handed to the voice client, i.e. the playback position.
+        self.frames = 0
+        self._gain = self._volume
+        self._mean_square = self.TARGET_RMS ** 2
+        self._sos = None
+        self._zi = None
+
+        if numpy is not None:
+            self._buffer = numpy.empty((self.SAMPLES, self.CHANNELS), dtype=numpy.float32)
+            self._output = numpy.empty((self.SAMPLES, self.CHANNELS), dtype=numpy.int16)
+            self._gains = numpy.empty((self.SAMPLES, 1), dtype=numpy.float32)
+            self._ramp = numpy.linspace(0.0, 1.0, self.SAMPLES, dtype=numpy.float32).reshape(-1, 1)
+
+        self.configure(normalize=normalize, bass_boost=bass_boost)
+
+    @classmethod
+    def supports(cls, *, normalize: bool = False, bass_boost: float = 0.0):
+        """Whether the requested filters are available with the installed libraries."""
+
+        if normalize or bass_boost:
+            return numpy is not None and (not bass_boost or scipy_signal is not None)
+        return True
+
+    def configure(self, *, normalize: bool = False, bass_boost: float = 0.0):
+        self.normalize = normalize and numpy is not None
+        self.bass_boost = bass_boost if numpy is not None and scipy_signal is not None else 0.0
+
+        if not self.bass_boost:
+            self._sos = self._zi = None
+            return
+
+        # Low shelf from the RBJ audio EQ cookbook, with a shelf slope of 1.
+        a = 10 ** (self.bass_boost / 40)
+        w0 = 2 * math.pi * self.BASS_BOOST_FREQUENCY / discord.opus.Encoder.SAMPLING_RATE
+        cos_w0 = math.cos(w0)
+        alpha = math.sin(w0) / 2 * math.sqrt(2)
+        sqrt_a = 2 * math.sqrt(a) * alpha
+
+        b0 = a * ((a + 1) - (a - 1) * cos_w0 + sqrt_a)
+        b1 = 2 * a * ((a - 1) - (a + 1) * cos_w0)
+        b2 = a * ((a + 1) - (a - 1) * cos_w0 - sqrt_a)
+        a0 = (a + 1) + (a - 1) * cos_w0 + sqrt_a
+        a1 = -2 * ((a - 1) + (a + 1) * cos_w0)
+        a2 = (a + 1) + (a - 1) * cos_w0 - sqrt_a
+
+        self._sos = numpy.array([[b0 / a0, b1 / a0, b2 / a0, 1.0, a1 / a0, a2 / a0]])
+        if self._zi is None:
+            self._zi = numpy.zeros((1, 2, self.CHANNELS))
+
+    def read(self):
+        if numpy is None:
+            data = super().read()
+            if data:
+                self.frames += 1
+            return data
+
+        data = self.original.read()
+        if not data:
+            return data
+        self.frames += 1
+
+        samples = numpy.frombuffer(data, dtype=numpy.int16).reshape(-1, self.CHANNELS)
+        count = len(samples)
+        buffer = self._buffer[:count]
+        buffer[...] = samples
+
+        if self._sos is not None:
+            # sosfilt can't write into given arrays, its results are copied back so the buffers stay fixed.
+            filtered, zi = scipy_signal.sosfilt(self._sos, buffer, axis=0, zi=self._zi)
+            buffer[...] = filtered
+            self._zi[...] = zi
+
+        target = min(self._volume, 2.0)
+        if self.normalize:
+            flat = buffer.reshape(-1)
+            mean_square = float(numpy.dot(flat, flat)) / flat.size
+            # Silence would drag the average down and blow up the gain.
+            if mean_square > 1.0:
+                self._mean_square += (mean_square - self._mean_square) * self.LOUDNESS_SMOOTHING
+            target *= min(max(self.TARGET_RMS / math.sqrt(self._mean_square), self.MIN_NORMALIZE_GAIN),
+                          self.MAX_NORMALIZE_GAIN)
+
+        if abs(target - self._gain) < 1e-3:
+            self._gain = target
+            buffer *= target
+        else:
+            # Ramp halfway to the target within this frame, the rest follows over the next frames.
+            step = (target - self._gain) / 2
+            gains = self._gains[:count]
+            numpy.multiply(self._ramp[:count], step, out=gains)
+            gains += self._gain
+            buffer *= gains
+            self._gain += step
+
+        numpy.clip(buffer, -32768, 32767, out=buffer)
+        output = self._output[:count]
+        numpy.copyto(output, buffer, casting='unsafe')
+        return output.tobytes()
+
+    @classmethod
+    def crossfade(cls, outgoing: bytes, incoming: bytes, start: float, end: float):
+        """Mixes two frames, fading from ``outgoing`` into ``incoming`` from ``start`` to ``end`` of the way.
+
+        Equal power weights, so the loudness doesn't dip halfway through. Needs NumPy.
+        """
+
+        if len(outgoing) != len(incoming):
+            return outgoing or incoming
+
+        a = numpy.frombuffer(outgoing, dtype=numpy.int16).reshape(-1, cls.CHANNELS).astype(numpy.float32)
+        b = numpy.frombuffer(incoming, dtype=numpy.int16).reshape(-1, cls.CHANNELS).astype(numpy.float32)
+        progress = numpy.linspace(start, end, len(a), endpoint=False, dtype=numpy.float32).reshape(-1, 1)
+        numpy.clip(progress, 0.0, 1.0, out=progress)
+        progress *= math.pi / 2
+        a *= numpy.cos(progress)
+        b *= numpy.sin(progress)
+        a += b
+        numpy.clip(a, -32768, 32767, out=a)
+        return a.astype(numpy.int16).tobytes()
+
+
+class TrackSource:
+    """Track metadata and playback position shared by :class:`YTDLSource` and :class:`YTDLOpusSource`."""
+
+    slot = None
+
+    def set_metadata(self, requester: discord.Member, channel: discord.abc.Messageable, data: dict):
+        self.requester = requester
+        self.channel = channel
+        self.data = data
+
+        self.uploader = data.get('uploader')
+        self.uploader_url = data.get('uploader_url')
+        date = data.get('upload_date')
+        # Songs played from the audio cache may only carry the persisted metadata.
+        self.upload_date = date[6:8] + '.' + date[4:6] + '.' + date[0:4] if date else None
+        self.title = data.get('title')
+        self.thumbnail = data.get('thumbnail')
+        self.description = data.get('description')
+        self.duration = self.parse_duration(int(data.get('duration') or 0))
+        self.tags = data.get('tags')
+        self.url = data.get('webpage_url')
+        self.views = data.get('view_count')
+        self.likes = data.get('like_count')
+        self.dislikes = data.get('dislike_count')
+        self.stream_url = data.get('url')
+        self.expires_at = ExtractionCache.stream_expiry(data)
+
+    def __str__(self):
+        return '**{0.title}** by **{0.uploader}**'.format(self)
+
+    @property
+    def position(self):
+        """Seconds of audio played so far."""
+
+        return self.frames * discord.opus.Encoder.FRAME_LENGTH / 1000
+
+    @staticmethod
+    def parse_duration(duration: int):
+        minutes, seconds = divmod(duration, 60)
+        hours, minutes = divmod(minutes, 60)
+        days, hours = divmod(hours, 24)
+
+        duration = []
+        if days > 0:
+            duration.append('{} days'.format(days))
+        if hours > 0:
+            duration.append('{} hours'.format(hours))
+        if minutes > 0:
+            duration.append('{} minutes'.format(minutes))
+        if seconds > 0:
+            duration.append('{} seconds'.format(seconds))
+
+        return ', '.join(duration)
+
+
+class YTDLSource(TrackSource, AudioProcessor):
+    YTDL_OPTIONS = {
+        'format': 'bestaudio/best',
+        'extractaudio': True,
+        'audioformat': 'mp3',
+        'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
+        'restrictfilenames': True,
+        'noplaylist': True,
+        'nocheckcertificate': True,
+        'ignoreerrors': False,
+        'logtostderr': False,
+        'quiet': True,
+        'no_warnings': True,
+        'default_search': 'auto',
+        'source_address': '0.0.0.0',
+    }
+
+    FFMPEG_OPTIONS = {
+        'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+        'options': '-vn',
+    }
+
+    # Files of the audio cache are local, the reconnect options only apply to network streams.
+    FFMPEG_FILE_OPTIONS = {
+        'options': '-vn',
+    }
+
+    # Playlists are capped so a huge mix can't flood a guild's queue.
+    MAX_PLAYLIST_SIZE = 500
+
+    ytdl = youtube_dl.YoutubeDL(YTDL_OPTIONS)
+    # Expands playlists into lightweight entries with a single request, single videos are fully extracted.
+    ytdl_flat = youtube_dl.YoutubeDL(dict(YTDL_OPTIONS, extract_flat='in_playlist', playlistend=MAX_PLAYLIST_SIZE))
+    cache = ExtractionCache()
+    index = TrackIndex()
+    audio_cache = AudioCache()
+    shared_streams = SharedStreamHub()
+    ffmpeg_limiter = FFmpegLimiter()
+    executor = ExtractionExecutor()
+    flights = SingleFlight()
+    suggestions = SearchSuggestions()
+
+    # Opus streams played at 100% volume skip the PCM decode, volume scaling and re-encode.
+    OPUS_PASSTHROUGH = True
+
+    passthrough = False
+
+    def __init__(self, requester: discord.Member, channel: discord.abc.Messageable, source: discord.FFmpegPCMAudio, *, data: dict, volume: float = 0.5,
+                 filters: dict = None):
+        super().__init__(source, volume, **(filters or {}))
+        self.set_metadata(requester, channel, data)
+
+    def cleanup(self):
+        super().cleanup()
+        if self.slot is not None:
+            self.slot.release()
+
+    @classmethod
+    async def create_source(cls, ctx: discord.ApplicationContext, search: str, *, loop: asyncio.BaseEventLoop = None):
+        info = await cls.resolve(search, guild_id=ctx.guild.id, loop=loop)
+        return cls.from_info(ctx.author, ctx.channel, info)
+
+    @classmethod
+    def from_info(cls, requester: discord.Member, channel: discord.abc.Messageable, info: dict, *, volume: float = 0.5,
+                  filters: dict = None, path: str = None, start: float = 0.0):
+        """Spawns the ffmpeg subprocess for an already resolved info dict, or for a file of the audio cache.
+
+        Opus audio played at full volume and without filters gets a
+        :class:`YTDLOpusSource`, everything else is decoded to PCM so the
+        audio stage can be applied. A ``start`` position seeks on the input
+        side, so ffmpeg jumps there instead of decoding from the beginning.
+        """
+
+        if path is not None:
+            stream, options, opus = path, cls.FFMPEG_FILE_OPTIONS, AudioCache.is_opus(path)
+        else:
+            stream, options, opus = info['url'], cls.FFMPEG_OPTIONS, info.get('acodec') == 'opus'
+
+        if start:
+            options = dict(options, before_options='-ss {:.2f} {}'.format(start, options.get('before_options', '')).strip())
+
+        try:
+            if cls.OPUS_PASSTHROUGH and opus and volume == 1.0 and not any((filters or {}).values()):
+                source = YTDLOpusSource(requester, channel, stream, data=info, **options)
+            else:
+                if cls.shared_streams.enabled and info.get('webpage_url') and not start:
+                    audio = cls.shared_streams.reader(info['webpage_url'], stream, options)
+                else:
+                    audio = discord.FFmpegPCMAudio(stream, **options)
+                source = cls(requester, channel, audio, data=info, volume=volume, filters=filters)
+        except discord.ClientException:
+            raise YTDLError("FFmpegPCMAudio Subprocess failed to be created. Is one already running?")
+
+        source.frames = round(start * 1000 / discord.opus.Encoder.FRAME_LENGTH)
+        return source
+
+    @classmethod
+    async def resolve(cls, search: str, *, guild_id: int = None, loop: asyncio.BaseEventLoop = None):
+        """Returns the info dict for ``search``, from the cache if a fresh entry exists."""
+
+        info = cls.cache.get(search)
+        if info is None:
+            info = await cls.extract(search, guild_id=guild_id, loop=loop)
+        return info
+
+    @classmethod
+    async def resolve_all(cls, search: str, *, guild_id: int = None, loop: asyncio.BaseEventLoop = None):
+        """Like :meth:`resolve`, but playlist URLs expand to all of their entries.
+
+        Returns the playlist title, ``None`` for single tracks, and a list of info dicts.
+        """
+
+        info = cls.cache.get(search)
+        if info is not None:
+            return None, [info]
+
+        if '://' in search:
+            # One flat extraction expands playlists, their entries are resolved in the background.
+            return await cls.extract_playlist(search, guild_id=guild_id, loop=loop)
+        return None, [await cls.extract(search, guild_id=guild_id, loop=loop)]
+
+    @classmethod
+    async def extract_playlist(cls, url: str, *, guild_id: int = None, loop: asyncio.BaseEventLoop = None):
+        """Expands ``url`` with one flat extraction.
+
+        Returns the playlist title and its flat entries, or ``None`` and a
+        single fully resolved info dict if ``url`` points to a single track.
+        """
+
+        return await cls.flights.run(('playlist', ExtractionCache.normalize(url)),
+                                     lambda: cls._extract_playlist(url, guild_id=guild_id, loop=loop), loop=loop)
+
+    @classmethod
+    async def _extract_playlist(cls, url: str, *, guild_id: int = None, loop: asyncio.BaseEventLoop = None):
+        with EXTRACTION_SECONDS.time('playlist'):
+            data = await cls.executor.extract_info(url, flat=True, guild_id=guild_id, loop=loop)
+        if data is None:
+            raise YTDLError('Couldn\'t fetch `{}`'.format(url))
+
+        if 'entries' not in data:
+            cls.cache.put(data, url, data.get('webpage_url'))
+            cls.index.store(data, url)
+            return None, [data]
+
+        entries = [entry for entry in data['entries'] if entry][:cls.MAX_PLAYLIST_SIZE]
+        if not entries:
+            raise YTDLError('Couldn\'t retrieve any tracks from `{}`'.format(url))
+        return data.get('title') or url, entries
+
+    @classmethod
+    async def extract(cls, search: str, *, guild_id: int = None, loop: asyncio.BaseEventLoop = None):
+        """Runs both extraction phases for ``search`` and stores the result in the cache.
+
+        Concurrent extractions of the same search share one run, which
+        counts against the guild that started it.
+        """
+
+        return await cls.flights.run(('extract', ExtractionCache.normalize(search)),
+                                     lambda: cls._extract(search, guild_id=guild_id, loop=loop), loop=loop)
+
+    @classmethod
+    async def _extract(cls, search: str, *, guild_id: int = None, loop: asyncio.BaseEventLoop = None):
+        # A search seen before maps straight to its track, skipping the flat search phase.
+        webpage_url = await cls.index.lookup(search, loop=loop)
+        if webpage_url is not None:
+            info = cls.cache.get(webpage_url)
+            if info is None:
+                info = await cls.process(webpage_url, guild_id=guild_id, loop=loop)
+            cls.cache.put(info, search)
+            cls.index.store(info, search)
+            return info
+
+        with EXTRACTION_SECONDS.time('flat'):
+            data = await cls.executor.extract_info(search, process=False, guild_id=guild_id, loop=loop)
+
+        if data is None:
+            raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
+
+        if 'entries' not in data:
+            process_info = data
+        else:
+            process_info = None
+            for entry in data['entries']:
+                if entry:
+                    process_info = entry
+                    break
+
+            if process_info is None:
+                raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
+
+        webpage_url = process_info['webpage_url']
+        info = cls.cache.get(webpage_url)
+        if info is None:
+            info = await cls.process(webpage_url, guild_id=guild_id, loop=loop)
+
+        cls.cache.put(info, search)
+        cls.index.store(info, search)
+        return info
+
+    @classmethod
+    async def process(cls, webpage_url: str, *, guild_id: int = None, loop: asyncio.BaseEventLoop = None):
+        """Runs the full extraction of ``webpage_url``, yielding a fresh stream URL."""
+
+        return await cls.flights.run(('process', webpage_url),
+                                     lambda: cls._process(webpage_url, guild_id=guild_id, loop=loop), loop=loop)
+
+    @classmethod
+    async def _process(cls, webpage_url: str, *, guild_id: int = None, loop: asyncio.BaseEventLoop = None):
+        with EXTRACTION_SECONDS.time('full'):
+            processed_info = await cls.executor.extract_info(webpage_url, guild_id=guild_id, loop=loop)
+
+        if processed_info is None:
+            raise YTDLError('Couldn\'t fetch `{}`'.format(webpage_url))
+
+        if 'entries' not in processed_info:
+            info = processed_info
+        else:
+            info = None
+            while info is None:
+                try:
+                    info = processed_info['entries'].pop(0)
+                except IndexError:
+                    raise YTDLError('Couldn\'t retrieve any matches for `{}`'.format(webpage_url))
+
+        cls.cache.put(info, webpage_url, info.get('webpage_url'))
+        cls.index.store(info, webpage_url)
+        return info
+
+
+class YTDLOpusSource(TrackSource, discord.FFmpegOpusAudio):
+    """Opus passthrough counterpart of :class:`YTDLSource`.
+
+    ffmpeg only remuxes the Opus packets into Ogg (``-c:a copy``) and the
+    library sends them as they are, nothing is decoded or re-encoded.
+    The volume is fixed at 100%.
+    """
+
+    passthrough = True
+
+    def __init__(self, requester: discord.Member, channel: discord.abc.Messageable, source: str, *, data: dict,
+                 before_options: str = None, options: str = None):
+        super().__init__(source, codec='opus', before_options=before_options, options=options)
+        self.set_metadata(requester, channel, data)
+        self.frames = 0
+
+    def cleanup(self):
+        discord.FFmpegOpusAudio.cleanup(self)
+        if self.slot is not None:
+            self.slot.release()
+
+    def read(self):
+        data = super().read()
+        if data:
+            self.frames += 1
+        return data
+
+    @property
+    def volume(self):
+        return 1.0
+
+    @volume.setter
+    def volume(self, value: float):
+        # Can't scale without decoding, a new volume applies once the next song starts.
+        pass
+
+    def configure(self, **filters):
+        pass
+
+
+class PrerollSource(discord.AudioSource):
+    """Wraps a source and reads its first frames ahead on a thread.
+
+    Handed to the :class:`TrackMixer` before the previous track ends, so
+    the track starts without waiting for ffmpeg to produce audio.
+    """
+
+    def __init__(self, source: discord.AudioSource, frames: int):
+        self.source = source
+        self._frames = collections.deque()
+        self._lock = threading.Lock()
+        self._started = False
+        self._ended = False
+        threading.Thread(target=self._fill, args=(frames,), daemon=True).start()
+
+    def _fill(self, count: int):
+        for _ in range(count):
+            with self._lock:
+                if self._started or self._ended:
+                    return
+                data = self.source.read()
+                if not data:
+                    self._ended = True
+                    return
+                self._frames.append(data)
+
+    @property
+    def position(self):
+        return self.source.position
+
+    def read(self):
+        with self._lock:
+            self._started = True
+            if self._frames:
+                return self._frames.popleft()
+            if self._ended:
+                return b''
+            return self.source.read()
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        with self._lock:
+            self._ended = True
+            self._frames.clear()
+        self.source.cleanup()
+
+
+class TrackMixer(discord.AudioSource):
+    """The source a guild's voice client plays, carrying on from one track to the next without a gap.
+
+    The next track is handed over with :meth:`queue` shortly before the
+    current one ends. Once the current track runs out, the mixer switches
+    within the same frame and calls ``on_switch`` from the player thread.
+    With ``crossfade`` seconds set, the end of a track is mixed with the
+    start of the next one in the audio stage. Opus passthrough tracks are
+    only switched, not mixed.
+    """
+
+    # Seconds the end of a track overlaps with the start of the next one, 0 switches without mixing.
+    crossfade = 0.0
+
+    def __init__(self, source: discord.AudioSource, *, on_switch=None):
+        self.current = source
+        self.upcoming = None
+        self.on_switch = on_switch
+        # Position of the current track at which the crossfade starts.
+        self._fade_at = None
+        # Source taking over the current track at the next frame, see :meth:`replace`.
+        self._replacement = None
+        self._opus = source.is_opus()
+        # Only guards the references, sources are never read while holding it.
+        self._lock = threading.Lock()
+        self.ended = False
+
+    def queue(self, source: discord.AudioSource, *, fade_at: float = None):
+        """Sets the track to continue with, fading into it from ``fade_at`` seconds into the current one."""
+
+        with self._lock:
+            self.upcoming = source
+            self._fade_at = fade_at if self.crossfade and numpy is not None else None
+
+    def replace(self, source: discord.AudioSource):
+        """Swaps the current track for ``source`` at the next frame, e.g. the same song reopened elsewhere.
+
+        The swap happens on the player thread, so the replaced source is never
+        cleaned up while it is being read.
+        """
+
+        with self._lock:
+            previous, self._replacement = self._replacement, source
+        if previous is not None:
+            previous.cleanup()
+
+    def read(self):
+        with self._lock:
+            replaced = None
+            if self._replacement is not None:
+                replaced, self.current, self._replacement = self.current, self._replacement, None
+            current, upcoming, fade_at = self.current, self.upcoming, self._fade_at
+        if replaced is not None:
+            replaced.cleanup()
+        self._opus = current.is_opus()
+
+        data = current.read()
+        if (data and upcoming is not None and fade_at is not None and not self._opus
+                and not upcoming.is_opus()):
+            position = getattr(current, 'position', 0.0)
+            if position >= fade_at:
+                start = (position - fade_at) / self.crossfade
+                incoming = upcoming.read()
+                if incoming:
+                    data = AudioProcessor.crossfade(data, incoming, start,
+                                                    start + discord.opus.Encoder.FRAME_LENGTH / 1000 / self.crossfade)
+
+        if not data and upcoming is not None:
+            with self._lock:
+                self.current, self.upcoming, self._fade_at = upcoming, None, None
+            self._opus = upcoming.is_opus()
+            data = upcoming.read()
+            current.cleanup()
+            if self.on_switch is not None:
+                self.on_switch()
+
+        self.ended = not data
+        return data
+
+    def is_opus(self):
+        return self._opus
+
+    def cleanup(self):
+        with self._lock:
+            current, replacement, self._replacement = self.current, self._replacement, None
+        current.cleanup()
+        if replacement is not None:
+            replacement.cleanup()
+
+
+class Song:
+    """A queued track.
+
+    Songs are enqueued as compact records holding only what the now
+    playing embed and ``/queue`` show, not the yt-dlp info dict. The
+    stream URL is resolved and the ffmpeg subprocess is spawned by
+    :meth:`prefetch` once the song gets close to the front of the queue,
+    the full info is only held from then on until :meth:`cleanup`.
+    """
+
+    __slots__ = ('title', 'url', 'uploader', 'uploader_url', 'length', 'thumbnail', 'requester_id', 'resolved',
+                 'channel', 'entry_id', 'row_id', 'enqueued_at', 'source', 'info', '_prefetch', '_embed')
+
+    # Fields whose values the record owns, the channel is shared with the client's cache.
+    RECORD_FIELDS = ('title', 'url', 'uploader', 'uploader_url', 'length', 'thumbnail', 'requester_id', 'resolved',
+                     'entry_id', 'row_id', 'enqueued_at')
+
+    def __init__(self, requester: discord.Member, channel: discord.abc.Messageable, data: dict, *,
+                 row_id: int = None):
+        self.requester_id = requester.id if requester is not None else None
+        self.channel = channel
+        self.entry_id = None
+        # Row of the song in the StateStore, set on the store's thread once its insert ran.
+        self.row_id = row_id
+        self.enqueued_at = time.monotonic()
+        self.source = None
+        self.info = None
+        self._prefetch = None
+        self._embed = None
+        self.update(data)
+
+    def __str__(self):
+        return '**{0.title}** by **{0.uploader}**'.format(self)
+
+    def update(self, data: dict):
+        """Copies the fields of the record from a yt-dlp info dict or a flat playlist entry."""
+
+        self.title = data.get('title')
+        self.url = data.get('webpage_url') or data.get('url')
+        self.uploader = data.get('uploader')
+        self.uploader_url = data.get('uploader_url')
+        # Seconds, 0 for live streams and unknown lengths.
+        self.length = int(data.get('duration') or 0)
+        self.thumbnail = data.get('thumbnail')
+        # Flat playlist entries only carry a title and a URL.
+        self.resolved = 'webpage_url' in data
+
+    def metadata(self):
+        """Returns the record as a minimal info dict, enough to show the song and to resolve it again."""
+
+        if self.resolved:
+            data = {'webpage_url': self.url, 'title': self.title, 'uploader': self.uploader,
+                    'uploader_url': self.uploader_url, 'duration': self.length or None, 'thumbnail': self.thumbnail}
+        else:
+            data = {'url': self.url, 'title': self.title, 'duration': self.length or None}
+        return {key: value for key, value in data.items() if value is not None}
+
+    def footprint(self):
+        """Approximate bytes held by the record while it is queued."""
+
+        return sys.getsizeof(self) + sum(sys.getsizeof(getattr(self, field)) for field in self.RECORD_FIELDS)
+
+    @property
+    def requester(self):
+        guild = getattr(self.channel, 'guild', None)
+        return guild.get_member(self.requester_id) if guild else None
+
+    @property
+    def duration(self):
+        return YTDLSource.parse_duration(self.length)
+
+    @property
+    def guild_id(self):
+        guild = getattr(self.channel, 'guild', None)
+        return guild.id if guild else None
+
+    def prefetch(self, loop: asyncio.BaseEventLoop, *, volume: float = 0.5, filters: dict = None):
+        """Starts resolving a fresh stream URL and spawning ffmpeg in the background."""
+
+        if self.source is None and self._prefetch is None:
+            self._prefetch = loop.create_task(self._prepare(loop, volume, filters))
+        return self._prefetch
+
+    async def prepare(self, loop: asyncio.BaseEventLoop, *, volume: float = 0.5, filters: dict = None):
+        """Waits until the song is ready to be played and returns its source.
+
+        A waiter going away doesn't cancel the prefetch, the armer and the
+        player share it. A prefetch cancelled by :meth:`cleanup` is started over.
+        """
+
+        while self.source is None:
+            prefetch = self.prefetch(loop, volume=volume, filters=filters)
+            # Unlike awaiting the task, only the waiter is cancelled if it goes away.
+            await asyncio.wait((prefetch,))
+            if self._prefetch is prefetch:
+                self._prefetch = None
+            if not prefetch.cancelled():
+                prefetch.result()
+        return self.source
+
+    async def resolve(self, loop: asyncio.BaseEventLoop):
+        """Fills in the full metadata and returns the info dict, its stream URL valid for the cache's expiry margin."""
+
+        webpage_url = self.url
+        info = YTDLSource.cache.get(webpage_url)
+        if info is None:
+            info = await YTDLSource.process(webpage_url, guild_id=self.guild_id, loop=loop)
+
+        if not self.resolved:
+            # Only a title and a URL to show so far, refreshed stream URLs don't change the embed.
+            self._embed = None
+            self.update(info)
+        return info
+
+    async def reopen(self, loop: asyncio.BaseEventLoop, *, start: float, volume: float = 0.5, filters: dict = None):
+        """Replaces the source with a new one starting ``start`` seconds into the song."""
+
+        self.cleanup()
+        await self._prepare(loop, volume, filters, start)
+        return self.source
+
+    async def _prepare(self, loop: asyncio.BaseEventLoop, volume: float, filters: dict, start: float = 0.0):
+        self.source = await self.open(loop, volume=volume, filters=filters, start=start)
+
+    async def open(self, loop: asyncio.BaseEventLoop, *, volume: float = 0.5, filters: dict = None, start: float = 0.0):
+        """Returns a new source for the song without touching :attr:`source`, e.g. to play it again on loop."""
+
+        # Hot tracks play from the audio cache and don't need a stream URL at all.
+        path = YTDLSource.audio_cache.lookup(self.url)
+        if path is not None:
+            info = YTDLSource.cache.get(self.url) or self.metadata()
+        else:
+            info = await self.resolve(loop)
+
+        slot = await YTDLSource.ffmpeg_limiter.acquire(loop)
+        try:
+            with FFMPEG_SPAWN_SECONDS.time():
+                source = YTDLSource.from_info(self.requester, self.channel, info, volume=volume, filters=filters,
+                                              path=path, start=start)
+        except BaseException:
+            slot.release()
+            raise
+        source.slot = slot
+        self.info = info
+        return source
+
+    def cleanup(self):
+        """Releases the prefetched ffmpeg subprocess and the full info of a song that won't be played."""
+
+        if self._prefetch is not None:
+            self._prefetch.cancel()
+            self._prefetch = None
+        if self.source is not None:
+            self.source.cleanup()
+            self.source = None
+        self.info = None
+
+    def create_embed(self):
+        """Returns the now playing embed, built once and reused for loops and message edits."""
+
+        if self._embed is not None:
+            return self._embed
+
+        embed = (discord.Embed(title='Now playing',
+                               description='```css\n{0.title}\n```'.format(self),
+                               color=discord.Color.blurple())
+                 .add_field(name='Duration', value=self.duration)
+                 .add_field(name='Requested by', value='<@{}>'.format(self.requester_id))
+                 .add_field(name='Uploader', value='[{0.uploader}]({0.uploader_url})'.format(self))
+                 .add_field(name='URL', value='[Click]({0.url})'.format(self))
+                 .set_thumbnail(url=self.thumbnail))
+
+        self._embed = embed
+        return embed
+
+
+class StateStore(SQLiteStore):
+    """Persists every guild's queue and player settings, so they survive a restart or crash.
+
+    The queue is journaled incrementally: every enqueue inserts one row and
+    every dequeue or removal touches only the affected rows. The song being
+    played stays stored, flagged as current, until the next one starts.
+    Writes don't wait for the database, a song's row ID is filled in once
+    its insert ran, before any later write for it.
+    """
+
+    SCHEMA = '''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        CREATE TABLE IF NOT EXISTS guilds (
+            guild_id INTEGER PRIMARY KEY,
+            voice_channel_id INTEGER,
+            loop INTEGER NOT NULL DEFAULT 0,
+            volume REAL NOT NULL DEFAULT 0.5
+        );
+        CREATE TABLE IF NOT EXISTS songs (
+            entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            current INTEGER NOT NULL DEFAULT 0,
+            requester_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS songs_guild_position ON songs(guild_id, position);
+    '''
+    DESCRIPTION = 'saved voice states'
+
+    def __init__(self, path: str = 'voice_states.db'):
+        super().__init__(path)
+
+    def save_settings(self, guild_id: int, voice_channel_id: int, loop: bool, volume: float):
+        self._submit(self._save_settings, guild_id, voice_channel_id, loop, volume)
+
+    def enqueued(self, guild_id: int, song: 'Song'):
+        self._submit(self._enqueued, guild_id, song, json.dumps(song.metadata()))
+
+    def dequeued(self, guild_id: int, song: 'Song'):
+        self._submit(self._dequeued, guild_id, song)
+
+    def removed(self, song: 'Song'):
+        self._submit(self._removed, song)
+
+    def reordered(self, songs):
+        self._submit(self._reordered, list(songs))
+
+    def cleared(self, guild_id: int):
+        self._submit(self._cleared, guild_id)
+
+    def forget(self, guild_id: int):
+        self._submit(self._forget, guild_id)
+
+    async def load(self, *, loop: asyncio.BaseEventLoop = None):
+        """Returns ``(guild_id, voice_channel_id, loop, volume, songs)`` for every stored guild.
+
+        ``songs`` holds ``(row_id, requester_id, channel_id, data)`` rows, the current song first.
+        """
+
+        return await self._call(self._load, loop=loop) or []
+
+    def _save_settings(self, guild_id: int, voice_channel_id: int, loop: bool, volume: float):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO guilds VALUES (?, ?, ?, ?)',
+                            (guild_id, voice_channel_id, int(loop), volume))
+
+    def _enqueued(self, guild_id: int, song: 'Song', data: str):
+        with self.db:
+            cursor = self.db.execute('INSERT INTO songs (guild_id, position, requester_id, channel_id, data) '
+                                     'VALUES (?, (SELECT COALESCE(MAX(position), 0) + 1 FROM songs WHERE guild_id = ?), '
+                                     '?, ?, ?)',
+                                     (guild_id, guild_id, song.requester_id, song.channel.id, data))
+        song.row_id = cursor.lastrowid
+
+    def _dequeued(self, guild_id: int, song: 'Song'):
+        with self.db:
+            self.db.execute('DELETE FROM songs WHERE guild_id = ? AND current = 1 AND entry_id IS NOT ?',
+                            (guild_id, song.row_id))
+            self.db.execute('UPDATE songs SET current = 1 WHERE entry_id = ?', (song.row_id,))
+
+    def _removed(self, song: 'Song'):
+        with self.db:
+            self.db.execute('DELETE FROM songs WHERE entry_id = ?', (song.row_id,))
+
+    def _reordered(self, songs: list):
+        with self.db:
+            self.db.executemany('UPDATE songs SET position = ? WHERE entry_id = ?',
+                                [(position, song.row_id) for position, song in enumerate(songs, start=1)])
+
+    def _cleared(self, guild_id: int):
+        with self.db:
+            self.db.execute('DELETE FROM songs WHERE guild_id = ? AND current = 0', (guild_id,))
+
+    def _forget(self, guild_id: int):
+        with self.db:
+            self.db.execute('DELETE FROM songs WHERE guild_id = ?', (guild_id,))
+            self.db.execute('DELETE FROM guilds WHERE guild_id = ?', (guild_id,))
+
+    def _load(self):
+        states = []
+        for guild_id, voice_channel_id, loop, volume in self.db.execute('SELECT * FROM guilds').fetchall():
+            songs = [(row_id, requester_id, channel_id, json.loads(data))
+                     for row_id, requester_id, channel_id, data in self.db.execute(
+                         'SELECT entry_id, requester_id, channel_id, data FROM songs WHERE guild_id = ? '
+                         'ORDER BY current DESC, position', (guild_id,))]
+            states.append((guild_id, voice_channel_id, bool(loop), volume, songs))
+        return states
+
+
+class SongQueue:
+    """A guild's queue of songs, keyed by their stable entry ID.
+
+    Songs are kept in an insertion ordered dict, so appending, taking the
+    next song and removing a song by ID are all O(1). Queued URLs are
+    indexed as well, to spot duplicates without walking the queue.
+    ``get`` waits for a song like :meth:`asyncio.Queue.get`.
+
+    In fair mode requesters take turns instead, by stride scheduling: every
+    requester with queued songs sits in a heap keyed by its pass, which
+    advances by ``1 / weight`` per song played. Picking the next song is
+    O(log r) for r requesters, and iterating the queue yields the effective
+    play order lazily.
+    """
+
+    # Entry IDs, handed out without waiting for the store.
+    _ids = itertools.count(1)
+    # In fair mode, songs a requester may get in a row while others are waiting.
+    MAX_CONSECUTIVE = 2
+    # Whether /play leaves out songs that are already queued, off by default.
+    skip_duplicates = False
+
+    def __init__(self, *, store: StateStore = None, guild_id: int = None):
+        self.store = store
+        self.guild_id = guild_id
+        self._entries = collections.OrderedDict()
+        # URL -> entry IDs of the queued songs with it, and the reverse.
+        self._urls = {}
+        self._entry_urls = {}
+        self._getters = collections.deque()
+        # Bumped on every change to the queue or its order, renderings of it are cached per version.
+        self.version = 0
+
+        self._fair = False
+        self.weights = {}
+        self.max_consecutive = self.MAX_CONSECUTIVE
+        # Requester ID -> that requester's songs, in queue order.
+        self._requesters = {}
+        # Heap of (pass, sequence, requester ID), an entry is live while it's the requester's one in _turns.
+        self._heap = []
+        self._turns = {}
+        self._passes = {}
+        self._sequence = itertools.count()
+        self._pass = 0.0
+        self._last = None
+        self._consecutive = 0
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return list(itertools.islice(iter(self), item.start, item.stop, item.step))
+
+        if item < 0:
+            item += len(self._entries)
+        if not 0 <= item < len(self._entries):
+            raise IndexError('queue index out of range')
+        return next(itertools.islice(iter(self), item, None))
+
+    def __iter__(self):
+        if self._fair:
+            return self._schedule()
+        return iter(self._entries.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, entry_id: int):
+        return entry_id in self._entries
+
+    def qsize(self):
+        return len(self._entries)
+
+    def footprint(self):
+        """Approximate bytes held by the queued song records."""
+
+        return sum(song.footprint() for song in self._entries.values())
+
+    @property
+    def fair(self):
+        return self._fair
+
+    @fair.setter
+    def fair(self, value: bool):
+        self._fair = value
+        self.version += 1
+
+    def set_weight(self, requester_id: int, weight: float):
+        if weight == 1:
+            self.weights.pop(requester_id, None)
+        else:
+            self.weights[requester_id] = weight
+        self.version += 1
+
+    def empty(self):
+        return not self._entries
+
+    def entry(self, entry_id: int):
+        return self._entries.get(entry_id)
+
+    def find(self, url: str):
+        """Returns the queued song with the given URL, or None."""
+
+        entry_ids = self._urls.get(url)
+        return self._entries[entry_ids[0]] if entry_ids else None
+
+    async def put(self, song: 'Song'):
+        self.put_nowait(song)
+
+    def put_nowait(self, song: 'Song'):
+        if song.entry_id is None:
+            song.entry_id = next(self._ids)
+        # Restored songs are already stored and keep their row.
+        if self.store is not None and song.row_id is None:
+            self.store.enqueued(self.guild_id, song)
+
+        self._entries[song.entry_id] = song
+        self.version += 1
+        self._index(song)
+
+        requester_id = self.requester_id(song)
+        songs = self._requesters.setdefault(requester_id, collections.OrderedDict())
+        songs[song.entry_id] = song
+        if requester_id not in self._turns:
+            # A returning requester doesn't get to catch up on the turns it missed.
+            self._push_turn(requester_id, max(self._passes.get(requester_id, 0.0), self._pass))
+
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+    async def get(self, *, persist: bool = True):
+        while not self._entries:
+            getter = asyncio.get_running_loop().create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except:
+                getter.cancel()
+                with contextlib.suppress(ValueError):
+                    self._getters.remove(getter)
+                raise
+
+        return self.get_nowait(persist=persist)
+
+    def get_nowait(self, *, persist: bool = True):
+        """Takes the next song off the queue.
+
+        With ``persist`` off the store isn't told, the caller does so once the song actually plays.
+        """
+
+        if not self._entries:
+            raise asyncio.QueueEmpty
+
+        if self._fair:
+            requester_id, self._pass = self._take_turn(self._heap, self._turns, self._passes, self._last,
+                                                       self._consecutive, lambda key: len(self._requesters[key]))
+            song = next(iter(self._requesters[requester_id].values()))
+            del self._entries[song.entry_id]
+        else:
+            _, song = self._entries.popitem(last=False)
+            requester_id = self.requester_id(song)
+
+        self._consecutive = self._consecutive + 1 if requester_id == self._last else 1
+        self._last = requester_id
+        self._forget(song)
+        if persist and self.store is not None:
+            self.store.dequeued(self.guild_id, song)
+        return song
+
+    @staticmethod
+    def requester_id(song: 'Song'):
+        return song.requester_id
+
+    def _push_turn(self, requester_id: int, pass_: float):
+        sequence = next(self._sequence)
+        self._turns[requester_id] = sequence
+        heapq.heappush(self._heap, (pass_, sequence, requester_id))
+
+    def _take_turn(self, heap: list, turns: dict, passes: dict, last: int, consecutive: int, remaining):
+        """Pops the requester whose turn it is, returns its ID and pass.
+
+        Works on the given heap and bookkeeping, so the effective order can
+        be simulated on copies. ``remaining`` returns a requester's number of
+        songs left, before taking this one.
+        """
+
+        def pop():
+            while heap:
+                entry = heapq.heappop(heap)
+                if turns.get(entry[2]) == entry[1]:
+                    return entry
+            return None
+
+        turn = pop()
+        if turn[2] == last and consecutive >= self.max_consecutive:
+            # Had enough turns in a row, let the next requester go first if there's one.
+            other = pop()
+            if other is not None:
+                heapq.heappush(heap, turn)
+                turn = other
+
+        pass_, _, requester_id = turn
+        passes[requester_id] = pass_ + 1 / self.weights.get(requester_id, 1)
+        if remaining(requester_id) > 1:
+            sequence = next(self._sequence)
+            turns[requester_id] = sequence
+            heapq.heappush(heap, (passes[requester_id], sequence, requester_id))
+        else:
+            del turns[requester_id]
+        return requester_id, pass_
+
+    def _schedule(self):
+        """Yields the songs in the order fair mode will play them, simulated on copies of the heap."""
+
+        turns = dict(self._turns)
+        heap = [entry for entry in self._heap if turns.get(entry[2]) == entry[1]]
+        heapq.heapify(heap)
+        passes = dict(self._passes)
+        songs = {requester_id: iter(songs.values()) for requester_id, songs in self._requesters.items()}
+        remaining = {requester_id: len(songs) for requester_id, songs in self._requesters.items()}
+        last, consecutive = self._last, self._consecutive
+
+        while heap:
+            requester_id, _ = self._take_turn(heap, turns, passes, last, consecutive, remaining.__getitem__)
+            remaining[requester_id] -= 1
+            consecutive = consecutive + 1 if requester_id == last else 1
+            last = requester_id
+            yield next(songs[requester_id])
+
+    def updated(self, song: 'Song'):
+        """Picks up the title and URL a lazily enqueued song got once it was resolved."""
+
+        if self._entries.get(song.entry_id) is not song:
+            return
+        self.version += 1
+        if self._entry_urls.get(song.entry_id) != song.url:
+            self._unindex(song)
+            self._index(song)
+
+    def _index(self, song: 'Song'):
+        url = song.url
+        if url is not None:
+            self._urls.setdefault(url, []).append(song.entry_id)
+            self._entry_urls[song.entry_id] = url
+
+    def _unindex(self, song: 'Song'):
+        url = self._entry_urls.pop(song.entry_id, None)
+        if url is not None:
+            entry_ids = self._urls[url]
+            entry_ids.remove(song.entry_id)
+            if not entry_ids:
+                del self._urls[url]
+
+    def _forget(self, song: 'Song'):
+        self.version += 1
+        self._unindex(song)
+
+        requester_id = self.requester_id(song)
+        songs = self._requesters[requester_id]
+        del songs[song.entry_id]
+        if not songs:
+            del self._requesters[requester_id]
+            # Leaves a dead heap entry behind, skipped when popped.
+            self._turns.pop(requester_id, None)
+            if len(self._heap) > 2 * len(self._turns) + 16:
+                self._heap = [entry for entry in self._heap if self._turns.get(entry[2]) == entry[1]]
+                heapq.heapify(self._heap)
+
+    def clear(self):
+        for song in self._entries.values():
+            song.cleanup()
+        self._entries.clear()
+        self._urls.clear()
+        self._entry_urls.clear()
+        self._requesters.clear()
+        self._heap.clear()
+        self._turns.clear()
+        self.version += 1
+        if self.store is not None:
+            self.store.cleared(self.guild_id)
+
+    def _reorder(self, songs):
+        self._entries = collections.OrderedDict((song.entry_id, song) for song in songs)
+        self.version += 1
+        # Same requesters with the same songs, only their own order changes.
+        for songs in self._requesters.values():
+            songs.clear()
+        for song in self._entries.values():
+            self._requesters[self.requester_id(song)][song.entry_id] = song
+        if self.store is not None:
+            self.store.reordered(self._entries.values())
+
+    def shuffle(self):
+        songs = list(self._entries.values())
+        random.shuffle(songs)
+        self._reorder(songs)
+
+    def interleave(self):
+        """Reorders the queue round-robin by requester, keeping each requester's own order."""
+
+        self._reorder(song for songs in itertools.zip_longest(*[list(songs.values())
+                                                                for songs in self._requesters.values()])
+                      for song in songs if song is not None)
+
+    def remove(self, index: int):
+        return self.remove_entry(self[index].entry_id)
+
+    def remove_entry(self, entry_id: int):
+        song = self._entries.pop(entry_id)
+        self._forget(song)
+        song.cleanup()
+        if self.store is not None:
+            self.store.removed(song)
+        return song
+
+    def move(self, index: int, position: int):
+        """Moves the song at ``index`` to ``position``, returns it. Only meaningful outside of fair mode."""
+
+        song = self[index]
+        if position <= 0 or position >= len(self._entries) - 1:
+            last = position > 0
+            self._entries.move_to_end(song.entry_id, last=last)
+            self._requesters[self.requester_id(song)].move_to_end(song.entry_id, last=last)
+            self.version += 1
+            if self.store is not None:
+                self.store.reordered(self._entries.values())
+        else:
+            songs = [other for other in self._entries.values() if other is not song]
+            songs.insert(position, song)
+            self._reorder(songs)
+        return song
+
+
+class QueuePages:
+    """Renders the pages of a guild's /queue embed lazily, cached until the queue changes."""
+
+    PER_PAGE = 10
+
+    def __init__(self, songs: SongQueue):
+        self.songs = songs
+        self.version = None
+        self._pages = {}
+
+    @property
+    def count(self):
+        return max(1, math.ceil(len(self.songs) / self.PER_PAGE))
+
+    def render(self, page: int):
+        if self.version != self.songs.version:
+            self._pages.clear()
+            self.version = self.songs.version
+
+        embed = self._pages.get(page)
+        if embed is None:
+            start = (page - 1) * self.PER_PAGE
+            queue = '\n'.join('`{0}.` [**{1.title}**]({1.url})'.format(i + 1, song)
+                               for i, song in enumerate(self.songs[start:start + self.PER_PAGE], start=start))
+            footer = 'Viewing page {}/{}'.format(page, self.count)
+            if self.songs.fair:
+                footer += ', in fair mode order'
+            embed = self._pages[page] = (discord.Embed(description='**{} tracks:**\n\n{}'.format(len(self.songs), queue))
+                                         .set_footer(text=footer))
+        return embed
+
+
+class QueueView(discord.ui.View):
+    """Previous and next buttons under a /queue message, pages are rendered as they're navigated to."""
+
+    def __init__(self, pages: QueuePages, page: int):
+        super().__init__(timeout=300, disable_on_timeout=True)
+        self.pages = pages
+        self.page = page
+        self.update_buttons()
+
+    def update_buttons(self):
+        self.previous_page.disabled = self.page <= 1
+        self.next_page.disabled = self.page >= self.pages.count
+
+    async def show(self, interaction: discord.Interaction, page: int):
+        # The queue may have shrunk since the message was sent.
+        self.page = min(max(page, 1), self.pages.count)
+        self.update_buttons()
+        await interaction.response.edit_message(embed=self.pages.render(self.page), view=self)
+
+    @discord.ui.button(label='Previous', style=discord.ButtonStyle.secondary)
+    async def previous_page(self, button: discord.ui.Button, interaction: discord.Interaction):
+        await self.show(interaction, self.page - 1)
+
+    @discord.ui.button(label='Next', style=discord.ButtonStyle.secondary)
+    async def next_page(self, button: discord.ui.Button, interaction: discord.Interaction):
+        await self.show(interaction, self.page + 1)
+
+
+class NowPlaying:
+    """Shows the playing song in one message per guild, edited in place instead of posting a new one.
+
+    Updates are coalesced, at most one edit per ``UPDATE_INTERVAL`` goes
+    out and it carries the latest state. With ``progress_interval`` set, a
+    progress bar above the embed is refreshed on that timer while a song plays.
+    """
+
+    UPDATE_INTERVAL = 2.0
+    BAR_LENGTH = 20
+    # Seconds between progress bar refreshes, 0 leaves the bar out.
+    progress_interval = 0.0
+
+    def __init__(self, loop: asyncio.BaseEventLoop):
+        self.loop = loop
+        self.message = None
+        self.song = None
+        self.paused = False
+        self._dirty = False
+        self._last_update = 0.0
+        self._task = None
+        self._ticker = None
+
+    def update(self, song: 'Song', *, paused: bool = False):
+        self.song = song
+        self.paused = paused
+        self._schedule()
+        if self.progress_interval and self._ticker is None:
+            self._ticker = self.loop.create_task(self._tick())
+
+    def _schedule(self):
+        self._dirty = True
+        if self._task is None:
+            self._task = self.loop.create_task(self._flush())
+
+    async def _tick(self):
+        while True:
+            await asyncio.sleep(max(self.progress_interval, self.UPDATE_INTERVAL))
+            if self.song is not None and not self.paused:
+                self._schedule()
+
+    @staticmethod
+    def format_time(seconds: float):
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds) if hours else '{}:{:02d}'.format(minutes, seconds)
+
+    @staticmethod
+    def parse_time(value: str):
+        """Parses ``90``, ``1:30`` or ``1:01:30`` into seconds, the inverse of :meth:`format_time`."""
+
+        seconds = 0
+        for part in value.strip().split(':'):
+            if not part.isdigit():
+                raise ValueError('Invalid time `{}`'.format(value))
+            seconds = seconds * 60 + int(part)
+        return seconds
+
+    def render(self):
+        """Returns the message content and embed for the current state."""
+
+        song = self.song
+        content = None
+        if self.progress_interval and song.source is not None:
+            position = song.source.position
+            duration = song.length
+            filled = min(self.BAR_LENGTH, int(self.BAR_LENGTH * position / duration)) if duration else 0
+            content = '`{}{}` {} / {}'.format('\u2588' * filled, '\u2591' * (self.BAR_LENGTH - filled),
+                                             self.format_time(position), self.format_time(duration))
+        if self.paused:
+            content = 'Paused' if content is None else 'Paused ' + content
+        return content, song.create_embed()
+
+    async def _flush(self):
+        try:
+            while self._dirty and self.song is not None:
+                delay = self._last_update + self.UPDATE_INTERVAL - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    # Stopped while waiting, there's nothing left to show.
+                    if self.song is None:
+                        break
+
+                self._dirty = False
+                content, embed = self.render()
+                channel = self.song.channel
+                if self.message is not None and self.message.channel.id == channel.id:
+                    try:
+                        await self.message.edit(content=content, embed=embed)
+                    except discord.NotFound:
+                        # Deleted by someone, post a new one.
+                        self.message = None
+                if self.message is None or self.message.channel.id != channel.id:
+                    self.message = await channel.send(content=content, embed=embed)
+                self._last_update = time.monotonic()
+        except discord.HTTPException as e:
+            print('Error occured while updating the now playing message {}'.format(e))
+        finally:
+            # A flush cancelled late must not drop the newer one that replaced it.
+            if self._task is asyncio.current_task():
+                self._task = None
+
+    def stop(self):
+        self.song = None
+        for task in (self._task, self._ticker):
+            if task is not None:
+                task.cancel()
+        self._task = self._ticker = None
+
+
+class VoiceState:
+    # Number of queued songs kept warm (fresh stream URL, ffmpeg spawned) ahead of playback.
+    PREFETCH_COUNT = 2
+    # A song that stops this many seconds before its end is considered to have failed.
+    END_TOLERANCE = 5
+    # Times a failed song is resumed before the player moves on.
+    MAX_RESUMES = 3
+    # Seconds a song waits for a dropped voice connection to come back before the player moves on.
+    RECONNECT_TIMEOUT = 30
+    # Seconds before the end of a song (and its crossfade) that the next one is handed to the mixer.
+    ARM_AHEAD = 10
+    # Frames of the next song read ahead once it's handed to the mixer.
+    PREROLL_FRAMES = 50
+
+    def __init__(self, bot: commands.Bot, ctx: discord.ApplicationContext = None, *, guild: discord.Guild = None,
+                 store: StateStore = None):
+        self.bot = bot
+        self._ctx = ctx
+        self.guild = guild or ctx.guild
+        self.store = store
+
+        self.current = None
+        self.voice = None
+        self.next = asyncio.Event()
+        self.songs = SongQueue(store=store, guild_id=self.guild.id)
+        self.queue_pages = QueuePages(self.songs)
+        
+        self._loop = False
+        self._volume = 0.5
+        self.filters = {'normalize': False, 'bass_boost': 0.0}
+        self.skip_votes = set()
+        self.now_playing = NowPlaying(bot.loop)
+        self.resolver = None
+        self.refresher = None
+        # Songs at the front of the queue as of the last prefetch.
+        self._warm = []
+        # Held while the current song is restarted, so a reconnect and a failed song don't both restart it.
+        self._resuming = asyncio.Lock()
+        self.armer = None
+        self.mixer = None
+        # The song queued in the mixer to play next and its source, already taken off the queue.
+        self._armed = None
+        self._armed_source = None
+        self._switched = False
+        self._skipped = False
+        self.stopped = False
+        self._resumes = 0
+        self._finished_at = None
+        # Lifecycle timestamps checked by the PlayerGovernor.
+        self.idle_since = time.monotonic()
+        self.alone_since = None
+        self.audio_player = bot.loop.create_task(self.audio_player_task())
+        
+    @property
+    def loop(self):
+        return self._loop
+
+    @property
+    def position(self):
+        """Seconds into the current song, counted from the frames read from its source."""
+
+        if self.current is None or self.current.source is None:
+            return 0.0
+        return self.current.source.position
+
+    async def resume_music(self):
+        """Restarts the current song where it stopped, e.g. after rejoining a dropped voice connection.
+
+        The stopped source can't be played again, ffmpeg is restarted at the
+        tracked position with an input-side seek instead.
+        """
+
+        async with self._resuming:
+            song = self.current
+            if song is None or song.source is None or self.voice.is_playing():
+                return
+
+            await song.reopen(self.bot.loop, start=self.position, volume=self._volume, filters=self.filters)
+            self._play(song.source)
+            self.now_playing.update(song)
+
+    async def reconnect(self, channel: discord.VoiceChannel):
+        """Rejoins ``channel`` after the voice connection dropped and resumes the current song."""
+
+        try:
+            self.voice = await channel.connect()
+        except (discord.ClientException, asyncio.TimeoutError) as e:
+            print('Error occured when trying to reconnect {}'.format(e))
+            return False
+
+        try:
+            await self.resume_music()
+        except Exception as e:
+            print('Error occured when trying to resume song {}'.format(e))
+            self.next.set()
+        return True
+
+    async def seek(self, position: float):
+        """Restarts the current song ``position`` seconds in, ffmpeg seeks on the input side.
+
+        The new source replaces the old one in the mixer, so playback jumps
+        without the player noticing the song ended.
+        """
+
+        song = self.current
+        source = await song.open(self.bot.loop, volume=self._volume, filters=self.filters, start=position)
+        if song is not self.current or song.source is None or self.mixer is None:
+            # The song ended while ffmpeg was starting.
+            source.cleanup()
+            return False
+
+        song.source = source
+        self._ensure_encoder(source)
+        self.mixer.replace(source)
+        self.now_playing.update(song, paused=self.voice.is_paused())
+        return True
+
+
+    @loop.setter
+    def loop(self, value: bool):
+        self._loop = value
+        self.save_settings()
+
+    @property
+    def fair(self):
+        """Whether requesters take turns, see :class:`SongQueue`."""
+
+        return self.songs.fair
+
+    @fair.setter
+    def fair(self, value: bool):
+        self.songs.fair = value
+        self.prefetch()
+
+    def set_weight(self, requester_id: int, weight: float):
+        """Gives a requester ``weight`` turns in fair mode for every turn of a requester with weight 1."""
+
+        self.songs.set_weight(requester_id, weight)
+        if self.songs.fair:
+            self.prefetch()
+
+    def save_settings(self):
+        if self.store is not None and self.voice is not None:
+            self.store.save_settings(self.guild.id, self.voice.channel.id, self._loop, self._volume)
+
+    @property
+    async def is_in_channel(self):
+        guild = self._ctx.guild
+        if guild.voice_client is None:
+            await self._ctx.respond('Not connected to any voice channel.',ephemeral=True)
+            return False
+        else:
+            return True
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float):
+        self._volume = value
+        self.save_settings()
+        if self.current is not None and self.current.source is not None:
+            self.current.source.volume = value
+
+    def set_filters(self, **filters):
+        """Updates the audio stage filters, applied right away to the playing song."""
+
+        self.filters.update(filters)
+        if self.current is not None and self.current.source is not None:
+            self.current.source.configure(**self.filters)
+
+    @property
+    def is_playing(self):
+        return self.voice and self.current
+
+    async def audio_player_task(self):
+        while True:
+            self.next.clear()
+            switched, self._switched = self._switched, False
+
+            if switched:
+                # The mixer already carried on with the armed song, without a gap.
+                self._persist_armed(self._armed)
+                self.current, self.current.source = self._armed, self._armed_source.source
+                self._armed = self._armed_source = None
+                TRACK_GAP_SECONDS.observe(0.0)
+                self._finished_at = None
+            else:
+                source = None
+                armed, armed_source = self._armed, self._armed_source
+                self._armed = self._armed_source = None
+                if armed_source is not None:
+                    # Armed, but the playing song was skipped or stopped before the mixer got to the next one.
+                    self._persist_armed(armed)
+                    self.current, self.current.source = armed, armed_source.source
+                    source = armed_source
+                elif (armed is not None and armed is not self.current) or not self.loop or self.current is None:
+                    previous = self.current
+                    if previous is not None and self.store is not None:
+                        self.store.removed(previous)
+                    self.current = None
+                    # The message keeps showing the last song, but its progress bar stops.
+                    self.now_playing.stop()
+
+                    if armed is not None and armed is not previous:
+                        # Already taken off the queue, but the playing song ended before it was ready.
+                        self._persist_armed(armed)
+                        self.current = armed
+                    else:
+                        # Wait for the next song. If none is added in time, the
+                        # PlayerGovernor disconnects the player due to performance
+                        # reasons.
+                        self.idle_since = time.monotonic()
+                        self.current = await self.songs.get()
+                        self.idle_since = None
+
+                    try:
+                        await self.current.prepare(self.bot.loop, volume=self._volume, filters=self.filters)
+                    except YTDLError as e:
+                        await self.current.channel.send('Skipping {}: {}'.format(str(self.current), str(e)))
+                        self.current = None
+                        continue
+                else:
+                    # Looping, but the played source is used up, start the song over.
+                    try:
+                        await self.current.reopen(self.bot.loop, start=0.0, volume=self._volume, filters=self.filters)
+                    except YTDLError as e:
+                        await self.current.channel.send('Skipping {}: {}'.format(str(self.current), str(e)))
+                        self.current = None
+                        continue
+
+                if self.current.source.passthrough and (self._volume != 1.0 or any(self.filters.values())):
+                    # Prefetched as Opus passthrough, but the volume or the filters changed since.
+                    self.current.cleanup()
+                    await self.current.prepare(self.bot.loop, volume=self._volume, filters=self.filters)
+                    source = None
+
+                self.save_settings()
+                try:
+                    self._play(source or self.current.source)
+                except Exception as e:
+                    print('Error occured when trying to play song {}'.format(e))
+                    await self.stop()
+                    return
+
+                now = time.monotonic()
+                if self._finished_at is not None:
+                    TRACK_GAP_SECONDS.observe(now - self._finished_at)
+                    self._finished_at = None
+
+            self.current.source.volume = self._volume
+            self._skipped = False
+            self._resumes = 0
+            if self.current.enqueued_at is not None:
+                FIRST_AUDIO_SECONDS.observe(time.monotonic() - self.current.enqueued_at)
+                # Only the first play counts, not loops or restarts.
+                self.current.enqueued_at = None
+
+            self.refresher = self.bot.loop.create_task(self.refresh_stream(self.current))
+            self.armer = self.bot.loop.create_task(self.arm_next(self.current))
+            self.prefetch()
+            YTDLSource.audio_cache.record_play(self.current.info, loop=self.bot.loop)
+            self.now_playing.update(self.current)
+
+            if switched and self.mixer.ended:
+                # The song ended right after the switch, before this task got to it.
+                self.next.set()
+            await self.next.wait()
+            self.refresher.cancel()
+            self.armer.cancel()
+
+    def _persist_armed(self, song: Song):
+        """Stores ``song`` as the playing one, replacing the song it follows.
+
+        Armed songs are taken off the queue early, but only stored as
+        dequeued once they play, so a crash before that doesn't lose the
+        song that was still playing.
+        """
+
+        if self.store is not None:
+            self.store.dequeued(self.guild.id, song)
+
+    def _play(self, source: discord.AudioSource):
+        self.mixer = TrackMixer(source, on_switch=self.song_switched)
+        if self._armed_source is not None:
+            self._ensure_encoder(self._armed_source)
+            self.mixer.queue(self._armed_source, fade_at=self._fade_at(self.current))
+        self.voice.play(self.mixer, after=self.play_next_song)
+
+    def _ensure_encoder(self, source: discord.AudioSource):
+        """Gives the voice client an encoder before a PCM track follows an Opus one in the mixer.
+
+        ``voice.play`` only creates the encoder if the mixer starts on a PCM track.
+        """
+
+        if not source.is_opus() and not self.voice.encoder:
+            self.voice.encoder = discord.opus.Encoder()
+
+    @staticmethod
+    def _fade_at(song: Song):
+        duration = song.length
+        return duration - TrackMixer.crossfade if duration and TrackMixer.crossfade else None
+
+    async def arm_next(self, song: Song):
+        """Hands the song that plays after ``song`` to the mixer shortly before ``song`` ends.
+
+        The next song is taken off the queue at that point, so its first
+        frames can be read ahead and it starts without a gap.
+        """
+
+        duration = song.length
+        if not duration:
+            # Live streams have no end to prepare for.
+            return
+
+        while song.source is not None:
+            # The position doesn't move while paused, check again after a while.
+            remaining = duration - song.source.position - TrackMixer.crossfade - self.ARM_AHEAD
+            if remaining <= 0:
+                break
+            await asyncio.sleep(min(remaining, 5))
+        else:
+            return
+
+        while True:
+            if self.loop:
+                armed, source = song, await song.open(self.bot.loop, volume=self._volume, filters=self.filters)
+                break
+
+            # Set before preparing, if the song ends first the player picks the armed song up.
+            armed = self._armed = await self.songs.get(persist=False)
+            try:
+                source = await armed.prepare(self.bot.loop, volume=self._volume, filters=self.filters)
+                if source.passthrough and (self._volume != 1.0 or any(self.filters.values())):
+                    armed.cleanup()
+                    source = await armed.prepare(self.bot.loop, volume=self._volume, filters=self.filters)
+                break
+            except YTDLError as e:
+                self._armed = None
+                if self.store is not None:
+                    self.store.removed(armed)
+                await armed.channel.send('Skipping {}: {}'.format(str(armed), str(e)))
+
+        self._armed = armed
+        self._armed_source = PrerollSource(source, self.PREROLL_FRAMES)
+        self._ensure_encoder(self._armed_source)
+        self.mixer.queue(self._armed_source, fade_at=self._fade_at(song))
+
+    async def refresh_stream(self, song: Song):
+        """Re-resolves the stream URL of the playing song in the background before it expires.
+
+        The playing ffmpeg process keeps its connection, the fresh URL is
+        only used if the song has to be resumed.
+        """
+
+        while True:
+            expires_at = ExtractionCache.stream_expiry(song.info or {})
+            if expires_at is None:
+                return
+
+            await asyncio.sleep(max(0.0, expires_at - YTDLSource.cache.expiry_margin - time.time()))
+            YTDLSource.cache.invalidate(song.url)
+            try:
+                song.info = await song.resolve(self.bot.loop)
+            except YTDLError:
+                return
+
+            refreshed = ExtractionCache.stream_expiry(song.info or {})
+            if refreshed is None or refreshed <= expires_at:
+                return
+
+    def _ended_early(self, song: Song, error: Exception = None):
+        if self._skipped or song.source is None:
+            return False
+        if error is not None:
+            return True
+
+        duration = song.length
+        return bool(duration) and song.source.position < duration - self.END_TOLERANCE
+
+    async def resume_song(self, song: Song):
+        """Restarts ffmpeg at the position where the failed song stopped."""
+
+        # The voice connection dropped, py-cord reconnects by itself or reconnect() rejoins.
+        deadline = time.monotonic() + self.RECONNECT_TIMEOUT
+        while self.voice is not None and not self.voice.is_connected() and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+        if self.stopped or self.voice is None or song is not self.current:
+            return
+        if not self.voice.is_connected():
+            print('Error occured when trying to resume song {}'.format(VoiceError('Voice connection lost')))
+            self.next.set()
+            return
+
+        async with self._resuming:
+            if self.voice.is_playing() or song is not self.current:
+                # Already resumed by reconnect().
+                return
+
+            position = song.source.position
+            self._resumes += 1
+            try:
+                expires_at = ExtractionCache.stream_expiry(song.info or {})
+                if expires_at is None or expires_at <= time.time() + YTDLSource.cache.expiry_margin:
+                    # The URL expired or is about to, the background refresh didn't get to it.
+                    YTDLSource.cache.invalidate(song.url)
+                await song.reopen(self.bot.loop, start=position, volume=self._volume, filters=self.filters)
+                self._play(song.source)
+            except Exception as e:
+                print('Error occured when trying to resume song {}'.format(e))
+                self.next.set()
+
+    def prefetch(self):
+        """Warms up the next ``PREFETCH_COUNT`` songs, leaving the rest of the queue unresolved.
+
+        Songs a reorder moved out of the front of the queue release their
+        ffmpeg process again.
+        """
+
+        head = self.songs[:self.PREFETCH_COUNT]
+        for song in self._warm:
+            if song not in head and self.songs.entry(song.entry_id) is song:
+                song.cleanup()
+        self._warm = head
+
+        if not YTDLSource.ffmpeg_limiter.can_prefetch():
+            return
+
+        for song in head:
+            prefetch = song.prefetch(self.bot.loop, volume=self._volume, filters=self.filters)
+            if prefetch is not None and not song.resolved:
+                # Lazily enqueued, resolved as part of the prefetch.
+                prefetch.add_done_callback(lambda _, song=song: self.songs.updated(song))
+
+    async def enqueue(self, song: Song):
+        await self.songs.put(song)
+        if self.current is not None:
+            self.prefetch()
+        if not song.resolved and (self.resolver is None or self.resolver.done()):
+            self.resolver = self.bot.loop.create_task(self.resolver_task())
+
+    async def resolver_task(self):
+        """Fills in the metadata of lazily enqueued songs, one extraction at a time in queue order."""
+
+        failed = set()
+        while True:
+            song = next((song for song in self.songs
+                         if not song.resolved and song._prefetch is None and song.entry_id not in failed), None)
+            if song is None:
+                return
+
+            try:
+                await song.resolve(self.bot.loop)
+            except YTDLError:
+                # Left in the queue, the player reports the error once the song comes up.
+                failed.add(song.entry_id)
+            else:
+                self.songs.updated(song)
+
+    def play_next_song(self, error=None):
+        # Called from the voice client's player thread, which may only finish once the bot shut down.
+        if not self.bot.loop.is_closed():
+            self.bot.loop.call_soon_threadsafe(self._song_finished, error)
+
+    def song_switched(self):
+        # Called from the voice client's player thread, the mixer moved on to the armed song.
+        if not self.bot.loop.is_closed():
+            self.bot.loop.call_soon_threadsafe(self._song_switched)
+
+    def _song_switched(self):
+        self._switched = True
+        self.next.set()
+
+    def _song_finished(self, error=None):
+        song = self.current
+        if song is not None and self._resumes < self.MAX_RESUMES and self._ended_early(song, error):
+            # Expired stream URL or a crashed ffmpeg, pick the song up where it stopped.
+            self.bot.loop.create_task(self.resume_song(song))
+            return
+
+        if error:
+            print('Error occured while playing song {}'.format(VoiceError(str(error))))
+        # Gaps are only measured between songs that follow each other directly.
+        self._finished_at = time.monotonic() if len(self.songs) or self.loop else None
+        self.next.set()
+
+    def skip(self):
+        self.skip_votes.clear()
+
+        if self.is_playing:
+            self._skipped = True
+            self.voice.stop()
+
+    async def stop(self, *, forget: bool = True):
+        """Stops playing and disconnects, forgetting the saved queue unless ``forget`` is off.
+
+        On shutdown the queue stays saved, so it is restored after the restart.
+        """
+
+        self.stopped = True
+        if not forget:
+            # Detached first, so nothing torn down below is persisted either.
+            self.store = self.songs.store = None
+        self.songs.clear()
+    #proper cleanup
+        self._skipped = True
+        if self.voice:
+            self.voice.stop()
+            await self.voice.disconnect()
+            self.voice = None
+        if self.audio_player:
+            self.audio_player.cancel()
+            self.audio_player = None
+        if self.resolver:
+            self.resolver.cancel()
+            self.resolver = None
+        if self.refresher:
+            self.refresher.cancel()
+            self.refresher = None
+        if self.armer:
+            self.armer.cancel()
+            self.armer = None
+        if self._armed_source is not None:
+            self._armed_source.cleanup()
+        elif self._armed is not None:
+            self._armed.cleanup()
+        self._armed = self._armed_source = None
+        self.now_playing.stop()
+        if self.store is not None:
+            self.store.forget(self.guild.id)
+        
+            
+
+def _download_track(url: str, options: dict, format: str):
+    """Executor target for :class:`DownloadManager`, downloads and transcodes one track."""
+
+    with youtube_dl.YoutubeDL(options) as ydl:
+        info = ydl.extract_info(url, download=True)
+        filename = ydl.prepare_filename(info)
+    return filename.rsplit(".", 1)[0] + f'.{format}', info.get('title', 'Unknown')
+
+
+class DownloadJob:
+    __slots__ = ('key', 'directory', 'title', 'task', 'listeners')
+
+    def __init__(self, key: tuple, directory: str, title: str):
+        self.key = key
+        self.directory = directory
+        self.title = title
+        self.task = None
+        self.listeners = []
+
+    def report(self, text: str):
+        for listener in self.listeners:
+            listener(text)
+
+
+class DownloadProgress:
+    """Posts coalesced progress updates of a download to the deferred followup."""
+
+    UPDATE_INTERVAL = 2.0
+
+    def __init__(self, ctx: discord.ApplicationContext, loop: asyncio.BaseEventLoop):
+        self._ctx = ctx
+        self.loop = loop
+        self.message = None
+        self._text = None
+        self._sent = None
+        self._last_update = 0.0
+        self._task = None
+
+    def __call__(self, text: str):
+        self._text = text
+        if self._task is None:
+            self._task = self.loop.create_task(self._flush())
+
+    async def _flush(self):
+        try:
+            while self._text != self._sent:
+                delay = self._last_update + self.UPDATE_INTERVAL - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                text = self._text
+                if self.message is None:
+                    self.message = await self._ctx.followup.send(text, wait=True)
+                else:
+                    await self.message.edit(content=text)
+                self._sent = text
+                self._last_update = time.monotonic()
+        except discord.HTTPException:
+            pass
+        finally:
+            if self._task is asyncio.current_task():
+                self._task = None
+
+    async def finish(self, text: str):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        try:
+            if self.message is None:
+                await self._ctx.followup.send(text)
+            else:
+                await self.message.edit(content=text)
+        except discord.HTTPException:
+            pass
+
+
+class DownloadManager:
+    """Runs ``/download`` jobs on a bounded worker pool instead of the event loop.
+
+    Every user can have at most ``per_user_limit`` downloads running.
+    Concurrent requests for the same track and format share one job, and
+    the last ``max_finished`` finished files are kept in ``directory`` so
+    later requests are served without transcoding again. A file is held
+    from :meth:`download` returning it until :meth:`release`, an evicted
+    file is only deleted once nobody is uploading it any more.
+    """
+
+    def __init__(self, max_workers: int = 2, per_user_limit: int = 1, *, directory: str = 'downloads',
+                 max_finished: int = 32):
+        self.max_workers = max_workers
+        self.per_user_limit = per_user_limit
+        self.directory = directory
+        self.max_finished = max_finished
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                               thread_name_prefix='download')
+        self._jobs = {}
+        self._finished = collections.OrderedDict()
+        self._user_jobs = collections.Counter()
+        # Directory -> uploads in progress from it, and the evicted directories among them.
+        self._uploads = collections.Counter()
+        self._evicted = set()
+
+    async def download(self, url: str, format: str, user_id: int, *, progress=None,
+                       loop: asyncio.BaseEventLoop = None):
+        """Downloads ``url`` transcoded to ``format``; returns the file name and the track title.
+
+        The file is kept until it is handed back to :meth:`release`.
+        """
+
+        loop = loop or asyncio.get_event_loop()
+
+        if self._user_jobs[user_id] >= self.per_user_limit:
+            raise YTDLError('You already have {} download(s) running, wait for them to finish.'.format(
+                self._user_jobs[user_id]))
+
+        self._user_jobs[user_id] += 1
+        try:
+            info = await YTDLSource.resolve(url, loop=loop)
+            key = (info['webpage_url'], format)
+
+            finished = self._finished.get(key)
+            if finished is not None:
+                if os.path.exists(finished[0]):
+                    self._finished.move_to_end(key)
+                    return self._hold(finished)
+                del self._finished[key]
+
+            job = self._jobs.get(key)
+            if job is None:
+                directory = os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest()[:16])
+                # Evicted but still being uploaded, the new job reuses the directory.
+                self._evicted.discard(directory)
+                job = self._jobs[key] = DownloadJob(key, directory, info.get('title', 'Unknown'))
+                job.task = loop.create_task(self._run(job, loop))
+
+            if progress is not None:
+                job.listeners.append(progress)
+            try:
+                # Shielded, so one requester going away doesn't cancel the job for the others.
+                return self._hold(await asyncio.shield(job.task))
+            finally:
+                if progress is not None:
+                    job.listeners.remove(progress)
+        finally:
+            self._user_jobs[user_id] -= 1
+            if not self._user_jobs[user_id]:
+                del self._user_jobs[user_id]
+
+    async def _run(self, job: DownloadJob, loop: asyncio.BaseEventLoop):
+        webpage_url, format = job.key
+
+        def progress_hook(d):
+            if d['status'] == 'downloading':
+                total = d.get('total_bytes') or d.get('total_bytes_estimate')
+                if total:
+                    text = 'Downloading **{}**: {:.0%}'.format(job.title, d.get('downloaded_bytes', 0) / total)
+                else:
+                    text = 'Downloading **{}**...'.format(job.title)
+                loop.call_soon_threadsafe(job.report, text)
+
+        def postprocessor_hook(d):
+            if d['status'] == 'started':
+                loop.call_soon_threadsafe(job.report, 'Converting **{}** to {}...'.format(job.title, format))
+
+        ydl_opts = {
+            'format': 'bestaudio/best',
+            'outtmpl': os.path.join(job.directory, '%(title)s.%(ext)s'),
+            'noplaylist': True,
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': format,
+                'preferredquality': '192',
+            }],
+            'progress_hooks': [progress_hook],
+            'postprocessor_hooks': [postprocessor_hook],
+            'quiet': True
+        }
 
-        if data is None:
-            raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
+        job.report('Starting download of **{}**...'.format(job.title))
+        try:
+            result = await loop.run_in_executor(self._executor, _download_track, webpage_url, ydl_opts, format)
+        except BaseException as e:
+            shutil.rmtree(job.directory, ignore_errors=True)
+            if isinstance(e, youtube_dl.utils.DownloadError):
+                raise YTDLError('Couldn\'t download `{}`'.format(webpage_url)) from e
+            raise
+        finally:
+            del self._jobs[job.key]
 
-        if 'entries' not in data:
-            process_info = data
-        else:
-            process_info = None
-            for entry in data['entries']:
-                if entry:
-                    process_info = entry
-                    break
+        self._finished[job.key] = result
+        while len(self._finished) > self.max_finished:
+            _, (filename, _) = self._finished.popitem(last=False)
+            directory = os.path.dirname(filename)
+            if directory in self._uploads:
+                self._evicted.add(directory)
+            else:
+                shutil.rmtree(directory, ignore_errors=True)
+        return result
 
-            if process_info is None:
-                raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
+    def _hold(self, result: tuple):
+        self._uploads[os.path.dirname(result[0])] += 1
+        return result
 
-        webpage_url = process_info['webpage_url']
-        partial = functools.partial(cls.ytdl.extract_info, webpage_url, download=False)
-        processed_info = await loop.run_in_executor(None, partial)
+    def release(self, filename: str):
+        """Marks an upload of a downloaded file as done, deleting it if it was evicted meanwhile."""
 
-        if processed_info is None:
-            raise YTDLError('Couldn\'t fetch `{}`'.format(webpage_url))
+        directory = os.path.dirname(filename)
+        self._uploads[directory] -= 1
+        if not self._uploads[directory]:
+            del self._uploads[directory]
+            if directory in self._evicted:
+                self._evicted.discard(directory)
+                shutil.rmtree(directory, ignore_errors=True)
 
-        if 'entries' not in processed_info:
-            info = processed_info
-        else:
-            info = None
-            while info is None:
-                try:
-                    info = processed_info['entries'].pop(0)
-                except IndexError:
-                    raise YTDLError('Couldn\'t retrieve any matches for `{}`'.format(webpage_url))
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
 
-        try:
-            cls = cls(ctx, discord.FFmpegPCMAudio(info['url'], **cls.FFMPEG_OPTIONS), data=info)
-        except discord.ClientException:
-            raise YTDLError("FFmpegPCMAudio Subprocess failed to be created. Is one already running?")
-        return cls
-    @staticmethod
-    def parse_duration(duration: int):
-        minutes, seconds = divmod(duration, 60)
-        hours, minutes = divmod(minutes, 60)
-        days, hours = divmod(hours, 24)
 
-        duration = []
-        if days > 0:
-            duration.append('{} days'.format(days))
-        if hours > 0:
-            duration.append('{} hours'.format(hours))
-        if minutes > 0:
-            duration.append('{} minutes'.format(minutes))
-        if seconds > 0:
-            duration.append('{} seconds'.format(seconds))
+class PlayerGovernor:
+    """Central lifecycle scheduler for every guild's :class:`VoiceState`.
 
-        return ', '.join(duration)
+    Periodically disconnects players that were idle for ``idle_timeout``
+    seconds, or alone in their channel for ``empty_timeout`` seconds, and
+    drops voice states whose player task ended, so ``voice_states`` and
+    the number of ffmpeg processes stay flat over long uptimes.
+    """
 
+    INTERVAL = 15
 
-class Song:
-    __slots__ = ('source', 'requester')
+    def __init__(self, bot: commands.Bot, voice_states: dict, *, idle_timeout: float = 180,
+                 empty_timeout: float = 60):
+        self.bot = bot
+        self.voice_states = voice_states
+        self.idle_timeout = idle_timeout
+        self.empty_timeout = empty_timeout
+        self.task = None
 
-    def __init__(self, source: YTDLSource):
-        self.source = source
-        self.requester = source.requester
+        self.reaped = collections.Counter()
 
-    def create_embed(self):
-        embed = (discord.Embed(title='Now playing',
-                               description='```css\n{0.source.title}\n```'.format(self),
-                               color=discord.Color.blurple())
-                 .add_field(name='Duration', value=self.source.duration)
-                 .add_field(name='Requested by', value=self.requester.mention)
-                 .add_field(name='Uploader', value='[{0.source.uploader}]({0.source.uploader_url})'.format(self))
-                 .add_field(name='URL', value='[Click]({0.source.url})'.format(self))
-                 .set_thumbnail(url=self.source.thumbnail))
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = self.bot.loop.create_task(self.run())
 
-        return embed
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
 
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.INTERVAL)
+            await self.sweep()
 
-class SongQueue(asyncio.Queue):
-    def __getitem__(self, item):
-        if isinstance(item, slice):
-            return list(itertools.islice(self._queue, item.start, item.stop, item.step))
-        else:
-            return self._queue[item]
+    async def sweep(self):
+        now = time.monotonic()
+        for guild_id, state in list(self.voice_states.items()):
+            reason = self.check(state, now)
+            if reason is not None:
+                await self.reap(guild_id, state, reason)
 
-    def __iter__(self):
-        return self._queue.__iter__()
+    def check(self, state: 'VoiceState', now: float):
+        """Returns why ``state`` should be torn down, or ``None`` if it is still in use."""
 
-    def __len__(self):
-        return self.qsize()
+        if state.audio_player is None or state.audio_player.done():
+            return 'stopped'
 
-    def clear(self):
-        self._queue.clear()
+        if state.idle_since is not None and now - state.idle_since >= self.idle_timeout:
+            return 'idle'
 
-    def shuffle(self):
-        random.shuffle(self._queue)
+        channel = state.voice.channel if state.voice else None
+        if channel is not None and not any(not member.bot for member in channel.members):
+            if state.alone_since is None:
+                state.alone_since = now
+            elif now - state.alone_since >= self.empty_timeout:
+                return 'alone'
+        else:
+            state.alone_since = None
 
-    def remove(self, index: int):
-        del self._queue[index]
+        return None
 
+    async def reap(self, guild_id: int, state: 'VoiceState', reason: str):
+        try:
+            await state.stop()
+        finally:
+            if self.voice_states.get(guild_id) is state:
+                del self.voice_states[guild_id]
+            self.reaped[reason] += 1
 
-class VoiceState:
-    def __init__(self, bot: commands.Bot, ctx: discord.ApplicationContext):
-        self.bot = bot
-        self._ctx = ctx
 
-        self.current = None
-        self.voice = None
-        self.next = asyncio.Event()
-        self.songs = SongQueue()
-        
-        self._loop = False
-        self._volume = 0.5
-        self.skip_votes = set()
-        self.NowPlayingMessage = None
-        self.audio_player = bot.loop.create_task(self.audio_player_task())
+class ShardCoordinator:
+    """Relays between the shard processes of a sharded deployment, runs in their parent process.
 
-    def __del__(self):
-        self.audio_player.cancel()
-        
-    @property
-    def loop(self):
-        return self._loop
+    Every shard process connects over a local ``multiprocessing.connection``
+    socket. Extraction results a shard caches are forwarded to all others,
+    and the latest status report of every shard is kept for ``/status``.
+    """
 
-    async def resume_music(self):
-        if self.current and not self.voice.is_playing():
-            self.voice.play(self.current.source, after=self.play_next_song)
-            # optionally reset other settings hre.
+    def __init__(self, address: tuple = ('127.0.0.1', 0), authkey: bytes = None):
+        self.authkey = authkey or os.urandom(16)
+        self._listener = multiprocessing.connection.Listener(address, authkey=self.authkey)
+        self.address = self._listener.address
+        # Connection -> lock serializing sends to it.
+        self._connections = {}
+        self._closed = False
+        self.statuses = {}
+        self.relayed = 0
 
+    def start(self):
+        threading.Thread(target=self._accept, name='shard-coordinator', daemon=True).start()
 
-    @loop.setter
-    def loop(self, value: bool):
-        self._loop = value
+    def _accept(self):
+        while not self._closed:
+            try:
+                connection = self._listener.accept()
+            except (OSError, multiprocessing.AuthenticationError):
+                continue
+            self._connections[connection] = threading.Lock()
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
 
-    @property
-    async def is_in_channel(self):
-        guild = self._ctx.guild
-        if guild.voice_client is None:
-            await self._ctx.respond('Not connected to any voice channel.',ephemeral=True)
-            return False
-        else:
-            return True
-    @property
-    def volume(self):
-        return self._volume
+    def _send(self, connection, message: tuple):
+        lock = self._connections.get(connection)
+        if lock is None:
+            return
+        try:
+            with lock:
+                connection.send(message)
+        except OSError:
+            self._connections.pop(connection, None)
 
-    @volume.setter
-    def volume(self, value: float):
-        self._volume = value
-        try: 
-            self.voice_client.source.volume = float(value) /100.0
-        except Exception as e:
+    def _serve(self, connection):
+        worker = None
+        try:
+            while True:
+                message = connection.recv()
+                kind = message[0]
+                if kind == 'hello':
+                    worker = message[1]
+                elif kind == 'cache':
+                    self.relayed += 1
+                    for other in list(self._connections):
+                        if other is not connection:
+                            self._send(other, message)
+                elif kind == 'status':
+                    self.statuses[worker] = message[1]
+                elif kind == 'query':
+                    self._send(connection, ('statuses', message[1], dict(self.statuses)))
+        except (EOFError, OSError):
             pass
+        finally:
+            self._connections.pop(connection, None)
+            self.statuses.pop(worker, None)
+            connection.close()
 
-    @property
-    def is_playing(self):
-        return self.voice and self.current
+    def close(self):
+        self._closed = True
+        self._listener.close()
+        for connection in list(self._connections):
+            connection.close()
 
-    async def audio_player_task(self):
-        while True:
-            self.next.clear()
-            #check if looping or
-            if not self.loop or self.current is None:
-                # Try to get the next song within 3 minutes.
-                # If no song will be added to the queue in time,
-                # the player will disconnect due to performance
-                # reasons.
-                try:
-                    async with timeout(5):  # 3 minutes
-                        self.current = await self.songs.get()
-                except asyncio.TimeoutError:
-                    
-                                 
-                    self.bot.loop.create_task(self.stop())    
-                    return False
 
-            self.current.source.volume = self._volume
-            try:
-                self.voice.play(self.current.source, after=self.play_next_song)
-            except Exception as e:
-                print('Error occured when trying to play song {}'.format(e))
-                await self.stop()
-                return
+class ShardClient:
+    """A shard process' connection to the :class:`ShardCoordinator`."""
 
+    STATUS_INTERVAL = 15
 
-            self.NowPlayingMessage = await self.current.source.channel.send(embed=self.current.create_embed())
+    def __init__(self, worker: int, address: tuple, authkey: bytes, loop: asyncio.BaseEventLoop):
+        self.worker = worker
+        self.loop = loop
+        self._connection = multiprocessing.connection.Client(address, authkey=authkey)
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._request_ids = itertools.count()
+        self.send('hello', worker)
+        threading.Thread(target=self._receive, name='shard-client', daemon=True).start()
 
-            await self.next.wait()
+    def send(self, *message):
+        try:
+            with self._lock:
+                self._connection.send(message)
+        except (OSError, ValueError) as e:
+            print('Error occured while talking to the shard coordinator {}'.format(e))
 
-    def play_next_song(self, error=None):
-        if error:
-            raise VoiceError(str(error))
+    def _receive(self):
+        try:
+            while True:
+                message = self._connection.recv()
+                if message[0] == 'cache':
+                    self.loop.call_soon_threadsafe(YTDLSource.cache.replicate, message[1], message[2])
+                elif message[0] == 'statuses':
+                    future = self._requests.pop(message[1], None)
+                    if future is not None:
+                        self.loop.call_soon_threadsafe(self._resolve, future, message[2])
+        except (EOFError, OSError):
+            pass
 
-        self.next.set()
+    @staticmethod
+    def _resolve(future: asyncio.Future, result):
+        if not future.done():
+            future.set_result(result)
 
-    def skip(self):
-        self.skip_votes.clear()
+    def report(self, status: dict):
+        self.send('status', status)
 
-        if self.is_playing:
-            self.voice.stop()
+    async def statuses(self, timeout: float = 5):
+        """Returns the latest status report of every shard process, by worker index."""
+
+        request_id = next(self._request_ids)
+        future = self._requests[request_id] = self.loop.create_future()
+        self.send('query', request_id)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._requests.pop(request_id, None)
+
+    def close(self):
+        self._connection.close()
 
-    async def stop(self):
-        self.songs.clear()
-    #proper cleanup
-        if self.voice:
-            self.voice.stop()
-            await self.voice.disconnect()
-            self.voice = None
-        if self.audio_player:
-            self.audio_player.cancel()
-            self.audio_player = None
-        
-            
 
 class Music(commands.Cog):
-    def __init__(self, bot: commands.Bot):
+    # Guilds rejoined at once after a restart, to stay clear of gateway rate limits.
+    RESTORE_CONCURRENCY = 2
+
+    def __init__(self, bot: commands.Bot, *, idle_timeout: float = 180, empty_timeout: float = 60,
+                 metrics_port: int = 0, shards: ShardClient = None):
         self.bot = bot
+        self.metrics_port = metrics_port
+        self.shards = shards
+        self.reporter = None
         self.voice_states = {}
+        self.downloads = DownloadManager()
+        self.store = StateStore()
+        self.governor = PlayerGovernor(bot, self.voice_states, idle_timeout=idle_timeout,
+                                       empty_timeout=empty_timeout)
+        self._restored = False
+        self.register_metrics()
+
+    def register_metrics(self):
+        """Gauges read from the live objects, only evaluated when the metrics endpoint is scraped."""
+
+        metrics.gauge('musicbot_voice_states', 'Guilds with a voice state.', lambda: len(self.voice_states))
+        metrics.gauge('musicbot_queued_songs', 'Songs waiting in all queues.',
+                      lambda: sum(len(state.songs) for state in self.voice_states.values()))
+        metrics.gauge('musicbot_longest_queue', 'Songs waiting in the longest queue.',
+                      lambda: max((len(state.songs) for state in self.voice_states.values()), default=0))
+        metrics.gauge('musicbot_queued_song_bytes', 'Approximate memory held by the queued song records.',
+                      lambda: sum(state.songs.footprint() for state in self.voice_states.values()))
+        metrics.gauge('musicbot_extraction_queue_depth', 'Extractions waiting for an executor slot.',
+                      lambda: YTDLSource.executor.queue_depth)
+        metrics.gauge('musicbot_extractions_in_flight', 'Extractions handed to the executor.',
+                      lambda: YTDLSource.executor.in_flight)
+        metrics.gauge('musicbot_ffmpeg_processes', 'Running ffmpeg processes.', lambda: YTDLSource.ffmpeg_limiter.active)
+        metrics.gauge('musicbot_extraction_cache', 'Extraction cache statistics.',
+                      lambda: {(key,): value for key, value in YTDLSource.cache.stats().items()}, ('stat',))
+        metrics.gauge('musicbot_audio_cache', 'Audio cache statistics.',
+                      lambda: {(key,): value for key, value in YTDLSource.audio_cache.stats().items()}, ('stat',))
+        metrics.gauge('musicbot_shared_streams', 'Shared stream statistics.',
+                      lambda: {(key,): value for key, value in YTDLSource.shared_streams.stats().items()}, ('stat',))
+        metrics.gauge('musicbot_extraction_flights', 'Extractions started and callers that joined one in flight.',
+                      lambda: {(key,): value for key, value in YTDLSource.flights.stats().items()}, ('stat',))
+        metrics.gauge('musicbot_search_suggestions', 'Search autocomplete statistics.',
+                      lambda: {(key,): value for key, value in YTDLSource.suggestions.stats().items()}, ('stat',))
+        metrics.gauge('musicbot_reaped_voice_states', 'Voice states torn down by the governor, by reason.',
+                      lambda: {(reason,): count for reason, count in self.governor.reaped.items()}, ('reason',))
 
     def get_voice_state(self, ctx: discord.ApplicationContext):
         state = self.voice_states.get(ctx.guild.id)
         if not state:
-            state = VoiceState(self.bot, ctx)
+            state = VoiceState(self.bot, ctx, store=self.store)
             self.voice_states[ctx.guild.id] = state
 
         return state
 
+    @commands.Cog.listener()
+    async def on_ready(self):
+        self.governor.start()
+        if self.metrics_port:
+            await metrics.start_server(port=self.metrics_port)
+        if self.shards is not None and self.reporter is None:
+            self.reporter = self.bot.loop.create_task(self.report_status())
+
+        # on_ready fires again after every gateway reconnect, only restore once.
+        if self._restored:
+            return
+        self._restored = True
+
+        semaphore = asyncio.Semaphore(self.RESTORE_CONCURRENCY)
+        # Sharded, the store holds the guilds of the other shard processes as well.
+        await asyncio.gather(*[self.restore_voice_state(semaphore, *state) for state in await self.store.load(loop=self.bot.loop)
+                               if self.owns(state[0])],
+                             return_exceptions=True)
+
+    def owns(self, guild_id: int):
+        """Whether the guild is on one of this process' shards."""
+
+        shard_ids = getattr(self.bot, 'shard_ids', None)
+        if not shard_ids:
+            return True
+        return (guild_id >> 22) % self.bot.shard_count in shard_ids
+
+    def status(self):
+        latency = self.bot.latency
+        return {
+            'shards': list(getattr(self.bot, 'shard_ids', None) or [0]),
+            'guilds': len(self.bot.guilds),
+            'voice_states': len(self.voice_states),
+            'playing': sum(1 for state in self.voice_states.values() if state.is_playing),
+            'queued': sum(len(state.songs) for state in self.voice_states.values()),
+            'queued_bytes': sum(state.songs.footprint() for state in self.voice_states.values()),
+            'latency_ms': round(latency * 1000) if math.isfinite(latency) else None,
+        }
+
+    async def report_status(self):
+        while True:
+            self.shards.report(self.status())
+            await asyncio.sleep(ShardClient.STATUS_INTERVAL)
+
+    async def restore_voice_state(self, semaphore: asyncio.Semaphore, guild_id: int, voice_channel_id: int,
+                                  loop: bool, volume: float, songs: list):
+        """Rejoins a guild's voice channel and restores its queue and settings from before a restart."""
+
+        async with semaphore:
+            guild = self.bot.get_guild(guild_id)
+            channel = guild.get_channel(voice_channel_id) if guild else None
+            if channel is None or not songs or guild_id in self.voice_states:
+                self.store.forget(guild_id)
+                return
+
+            try:
+                voice = await channel.connect()
+            except (discord.ClientException, asyncio.TimeoutError):
+                self.store.forget(guild_id)
+                return
+
+            state = VoiceState(self.bot, guild=guild, store=self.store)
+            state.voice = voice
+            state._loop = loop
+            state._volume = volume
+            self.voice_states[guild_id] = state
+
+            for row_id, requester_id, channel_id, data in songs:
+                requester = guild.get_member(requester_id)
+                if requester is None:
+                    try:
+                        requester = await guild.fetch_member(requester_id)
+                    except discord.HTTPException:
+                        requester = None
+                text_channel = guild.get_channel(channel_id)
+
+                song = Song(requester, text_channel, data, row_id=row_id)
+                if requester is None or text_channel is None:
+                    self.store.removed(song)
+                    continue
+                await state.songs.put(song)
+
     def cog_unload(self):
-        for state in self.voice_states.values():
-            self.bot.loop.create_task(state.stop())
+        self.governor.stop()
+        metrics.close()
+        # Saved queues are kept, so they are restored after a restart.
+        stopping = [self.bot.loop.create_task(state.stop(forget=False)) for state in self.voice_states.values()]
+        self.bot.loop.create_task(self.close_store(stopping))
+        YTDLSource.suggestions.shutdown()
+        YTDLSource.executor.shutdown()
+        YTDLSource.index.close()
+        self.downloads.shutdown()
+        YTDLSource.audio_cache.shutdown()
+        if self.reporter is not None:
+            self.reporter.cancel()
+        if self.shards is not None:
+            self.shards.close()
+
+    async def close_store(self, stopping: list):
+        """Closes the store once the players that might still write to it have stopped."""
+
+        try:
+            await asyncio.gather(*stopping, return_exceptions=True)
+        finally:
+            self.store.close()
 
     def cog_check(self, ctx: discord.ApplicationContext):
         if not ctx.guild:
@@ -317,21 +3744,29 @@ class Music(commands.Cog):
 
     async def cog_before_invoke(self, ctx: discord.ApplicationContext):
         ctx.voice_state = self.get_voice_state(ctx)
+        ctx.invoked_at = time.perf_counter()
+
+    async def cog_after_invoke(self, ctx: discord.ApplicationContext):
+        COMMAND_SECONDS.observe(time.perf_counter() - ctx.invoked_at, ctx.command.qualified_name)
 
     async def cog_command_error(self, ctx: discord.ApplicationContext, error: commands.CommandError):
+        COMMAND_ERRORS.inc(ctx.command.qualified_name)
         await ctx.respond('An error occurred: {}'.format(str(error)))
     #checks for sudden disconnect and reconnects the bot to the voice channel
     @commands.Cog.listener()
     async def on_voice_state_update(self, member, before,after):
-        if member.id == self.bot.user.id and before.channel is not None and after.channel is None:
-            voice_state = self.get_voice_state(before.guild.id)
-            if voice_state and voice_state.is_playing:
-                successfully_reconnected = await self.reconnect_voice_client(before.guild.id,before.channel)
-            if successfully_reconnected:
-                await voice_state.resume_music()
-            if voice_state and not voice_state.is_playing:
-                await voice_state.stop()
-                del self.voice_states[before.guild.id]
+        if member.id != self.bot.user.id or before.channel is None or after.channel is not None:
+            return
+
+        voice_state = self.voice_states.get(before.channel.guild.id)
+        if voice_state is None or voice_state.stopped:
+            # Left on purpose.
+            return
+
+        if not voice_state.is_playing or not await voice_state.reconnect(before.channel):
+            await voice_state.stop()
+            if self.voice_states.get(before.channel.guild.id) is voice_state:
+                del self.voice_states[before.channel.guild.id]
 
     @commands.slash_command(name='join', invoke_without_subcommand=True)
     async def _join(self, ctx: discord.ApplicationContext):
@@ -380,18 +3815,70 @@ class Music(commands.Cog):
         if not ctx.voice_state.is_playing:
             return await ctx.respond('Nothing being played at the moment.')
 
-        if 0 > volume > 100:
+        if not 0 <= volume <= 100:
             return await ctx.respond('Volume must be between 0 and 100')
 
         ctx.voice_state.volume = volume / 100
+        if ctx.voice_state.current.source.passthrough:
+            return await ctx.respond('Volume of the player set to {}%, starting with the next song'.format(volume))
         await ctx.respond('Volume of the player set to {}%'.format(volume))
+    @commands.slash_command(name='normalize')
+    async def _normalize(self, ctx: discord.ApplicationContext):
+        """Toggles loudness normalization across tracks."""
+
+        normalize = not ctx.voice_state.filters['normalize']
+        if not AudioProcessor.supports(normalize=normalize):
+            return await ctx.respond('Loudness normalization needs NumPy to be installed.', ephemeral=True)
+
+        ctx.voice_state.set_filters(normalize=normalize)
+        await ctx.respond('Loudness normalization {}'.format('enabled' if normalize else 'disabled'))
+
+    @commands.slash_command(name='bassboost')
+    async def _bassboost(self, ctx: discord.ApplicationContext, *, level: int):
+        """Boosts the bass by the given number of decibels, 0 turns it off."""
+
+        if not 0 <= level <= 12:
+            return await ctx.respond('Bass boost must be between 0 and 12 dB')
+        if not AudioProcessor.supports(bass_boost=level):
+            return await ctx.respond('Bass boost needs NumPy and SciPy to be installed.', ephemeral=True)
+
+        ctx.voice_state.set_filters(bass_boost=float(level))
+        await ctx.respond('Bass boost set to {} dB'.format(level))
+
     @commands.slash_command(name='restart')
     async def restart(self,ctx: discord.ApplicationContext):
         #bandaid fix a long time ago for the player, its not necessary now but its still here.
         await ctx.respond('Restarting bot...')
+        if self.shards is not None:
+            # Re-executing would start a second coordinator, the parent respawns a shard process that exits.
+            await self.bot.close()
+            return
         os.execv(sys.executable,['python3'] +sys.argv)
 	
 
+    @commands.slash_command(name='status')
+    async def _status(self, ctx: discord.ApplicationContext):
+        """Shows how busy the bot is, across all shard processes."""
+
+        if self.shards is None:
+            statuses = {0: self.status()}
+        else:
+            try:
+                statuses = await self.shards.statuses()
+            except asyncio.TimeoutError:
+                statuses = {}
+            statuses[self.shards.worker] = self.status()
+
+        embed = discord.Embed(title='Status', description='{} servers, {} playing, {} queued songs'.format(
+            sum(status['guilds'] for status in statuses.values()),
+            sum(status['playing'] for status in statuses.values()),
+            sum(status['queued'] for status in statuses.values())))
+        for worker, status in sorted(statuses.items()):
+            embed.add_field(name='Shards {}'.format(', '.join(map(str, status['shards']))),
+                            value='{guilds} servers, {playing} playing, {queued} queued ({0} KiB), {latency_ms} ms'
+                            .format(round(status['queued_bytes'] / 1024), **status))
+        await ctx.respond(embed=embed)
+
     @commands.slash_command(name='now', aliases=['current', 'playing'])
     async def _now(self, ctx: discord.ApplicationContext):
         """Displays the currently playing song."""
@@ -403,19 +3890,51 @@ class Music(commands.Cog):
     async def _pause(self, ctx: discord.ApplicationContext):
         """Pauses the currently playing song."""
 
-        if not ctx.voice_state.is_playing and ctx.voice_state.voice.is_playing():
+        if ctx.voice_state.is_playing and ctx.voice_state.voice.is_playing():
             ctx.voice_state.voice.pause()
-            await ctx.message.add_reaction('?')
+            ctx.voice_state.now_playing.update(ctx.voice_state.current, paused=True)
+            await ctx.respond('Pausing the current song')
 
     @commands.slash_command(name='resume')
     @commands.has_permissions(manage_guild=True)
     async def _resume(self, ctx: discord.ApplicationContext):
         """Resumes a currently paused song."""
 
-        if not ctx.voice_state.is_playing and ctx.voice_state.voice.is_paused():
+        if ctx.voice_state.is_playing and ctx.voice_state.voice.is_paused():
             ctx.voice_state.voice.resume()
+            ctx.voice_state.now_playing.update(ctx.voice_state.current)
             await ctx.respond("Resuming currently paused song")
 
+    @commands.slash_command(name='seek')
+    @commands.has_permissions(manage_guild=True)
+    async def _seek(self, ctx: discord.ApplicationContext, *, position: discord.Option(str, 'e.g. 90, 1:30 or 1:01:30')):
+        """Jumps to a position in the current song."""
+
+        if not ctx.voice_state.is_playing:
+            return await ctx.respond('Not playing any music right now...', ephemeral=True)
+
+        song = ctx.voice_state.current
+        if not song.length:
+            return await ctx.respond('Can\'t seek in a live stream.', ephemeral=True)
+
+        try:
+            seconds = NowPlaying.parse_time(position)
+        except ValueError as e:
+            return await ctx.respond(str(e), ephemeral=True)
+        if seconds >= song.length:
+            return await ctx.respond('The song is only {} long.'.format(NowPlaying.format_time(song.length)),
+                                     ephemeral=True)
+
+        async with ctx.typing():
+            try:
+                seeked = await ctx.voice_state.seek(seconds)
+            except YTDLError as e:
+                return await ctx.respond('An error occurred while processing this request: {}'.format(str(e)))
+        if seeked:
+            await ctx.respond('Jumped to {}'.format(NowPlaying.format_time(seconds)))
+        else:
+            await ctx.respond('The song ended before it could jump.', ephemeral=True)
+
     @commands.slash_command(name='stop')
     @commands.has_permissions(manage_guild=True)
     async def _stop(self, ctx: discord.ApplicationContext):
@@ -440,7 +3959,7 @@ class Music(commands.Cog):
             return await ctx.respond('Not playing any music right now...',ephemeral=True)
 
         voter = ctx.author
-        if voter == ctx.voice_state.current.requester:
+        if voter.id == ctx.voice_state.current.requester_id:
             await ctx.respond('Author requested to Skip Song')
             ctx.voice_state.skip()
 
@@ -466,19 +3985,12 @@ class Music(commands.Cog):
         if len(ctx.voice_state.songs) == 0:
             return await ctx.respond('Empty queue.')
 
-        items_per_page = 10
-        pages = math.ceil(len(ctx.voice_state.songs) / items_per_page)
-
-        start = (page - 1) * items_per_page
-        end = start + items_per_page
+        pages = ctx.voice_state.queue_pages
+        if not 1 <= page <= pages.count:
+            return await ctx.respond('Page must be between 1 and {}.'.format(pages.count), ephemeral=True)
 
-        queue = ''
-        for i, song in enumerate(ctx.voice_state.songs[start:end], start=start):
-            queue += '`{0}.` [**{1.source.title}**]({1.source.url})\n'.format(i + 1, song)
-
-        embed = (discord.Embed(description='**{} tracks:**\n\n{}'.format(len(ctx.voice_state.songs), queue))
-                 .set_footer(text='Viewing page {}/{}'.format(page, pages)))
-        await ctx.respond(embed=embed)
+        view = QueueView(pages, page) if pages.count > 1 else None
+        await ctx.respond(embed=pages.render(page), view=view)
 
     @commands.slash_command(name='shuffle')
     async def _shuffle(self, ctx: discord.ApplicationContext):
@@ -488,49 +4000,67 @@ class Music(commands.Cog):
             return await ctx.respond('Empty queue.')
 
         ctx.voice_state.songs.shuffle()
+        ctx.voice_state.prefetch()
         await ctx.respond('Shuffled Playlist')
+
+    @commands.slash_command(name='fair')
+    async def _fair(self, ctx: discord.ApplicationContext):
+        """Toggles fair mode, where requesters take turns instead of playing the queue in order.
+        Invoke this command again to play the queue in order.
+        """
+
+        ctx.voice_state.fair = not ctx.voice_state.fair
+        if ctx.voice_state.fair:
+            await ctx.respond('Requesters now take turns')
+        else:
+            await ctx.respond('Playing the queue in order')
+
+    @commands.slash_command(name='weight')
+    @commands.has_permissions(manage_guild=True)
+    async def _weight(self, ctx: discord.ApplicationContext, member: discord.Member, weight: float):
+        """Sets how many turns a member gets in fair mode, relative to everyone else's one."""
+
+        if not 0.1 <= weight <= 10:
+            return await ctx.respond('Weight must be between 0.1 and 10', ephemeral=True)
+
+        ctx.voice_state.set_weight(member.id, weight)
+        await ctx.respond('{} now gets {:g} turns in fair mode'.format(member.mention, weight))
+
+    @commands.slash_command(name='interleave')
+    async def _interleave(self, ctx: discord.ApplicationContext):
+        """Reorders the queue so requesters take turns."""
+
+        if len(ctx.voice_state.songs) == 0:
+            return await ctx.respond('Empty queue.')
+
+        ctx.voice_state.songs.interleave()
+        ctx.voice_state.prefetch()
+        await ctx.respond('Interleaved the queue by requester')
     
     @commands.slash_command(name='download',description= 'Download a song')
     async def download(self, ctx:discord.ApplicationContext, url:discord.Option(discord.SlashCommandOptionType.string), format: discord.Option(str, choices=['wav','mp3'])):
-    # Check the format
-	
-
-        # Download options for youtube-dl
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'outtmpl': 'downloads/%(title)s.%(ext)s',
-            'noplaylist': True,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': format,
-                'preferredquality': '192',
-            }],
-            'quiet': True
-        }
         await ctx.response.defer()
-        print("Recived Download command")
-        # Download the song
-        print("About to start youtube_dl.YoutubeDL")
-        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-            print("Inside youtube_dl.YoutubeDL block")
-            info = ydl.extract_info(url, download=True)
-            print("Extracted info")
-            filename = ydl.prepare_filename(info)
-            print("Prepared filename")
-            filename = filename.rsplit(".", 1)[0] + f'.{format}'
-        print("downloading",filename)
-        
+
+        # The transcode runs on the download pool, progress is posted to the deferred followup.
+        progress = DownloadProgress(ctx, self.bot.loop)
+        try:
+            filename, title = await self.downloads.download(url, format, ctx.author.id, progress=progress,
+                                                            loop=self.bot.loop)
+        except YTDLError as e:
+            return await progress.finish('An error occurred while processing this request: {}'.format(str(e)))
+
         # Extract and sanitize the song title
-        song_title = info.get('title', 'Unknown')
-        song_title = re.sub(r'[^\w\s-]', '', song_title).strip()  # remove non-alphanumeric, non-space, non-hyphen characters
+        song_title = re.sub(r'[^\w\s-]', '', title).strip()  # remove non-alphanumeric, non-space, non-hyphen characters
         song_title = re.sub(r'\s+', '_', song_title)  # replace spaces with underscores
         song_title = song_title[:255-len(format)-1]  # ensure the filename does not exceed 255 characters
 
-        # Upload the song
-        with open(filename, 'rb') as fp:
-            await ctx.followup.send(file=discord.File(fp, f'{song_title}.{format}'))
-            # Delete the song
-        os.remove(filename)
+        # Upload the song, the file is kept for reuse by later requests
+        try:
+            await progress.finish('Uploading **{}**...'.format(title))
+            with open(filename, 'rb') as fp:
+                await ctx.followup.send(file=discord.File(fp, f'{song_title}.{format}'))
+        finally:
+            self.downloads.release(filename)
 
 
     @commands.slash_command(name='remove')
@@ -539,10 +4069,28 @@ class Music(commands.Cog):
 
         if len(ctx.voice_state.songs) == 0:
             return await ctx.respond('Empty queue.')
+        if not 1 <= index <= len(ctx.voice_state.songs):
+            return await ctx.respond('Invalid queue index.', ephemeral=True)
 
         ctx.voice_state.songs.remove(index - 1)
+        ctx.voice_state.prefetch()
         await ctx.respond("removing song at index %d" %(index))
 
+    @commands.slash_command(name='move')
+    async def _move(self, ctx: discord.ApplicationContext, index: int, position: int):
+        """Moves a song in the queue from one index to another."""
+
+        if not 1 <= index <= len(ctx.voice_state.songs):
+            return await ctx.respond('Invalid queue index.', ephemeral=True)
+
+        if ctx.voice_state.fair:
+            return await ctx.respond('Songs can\'t be moved in fair mode, the queue order follows the requesters\' turns.',
+                                     ephemeral=True)
+
+        song = ctx.voice_state.songs.move(index - 1, position - 1)
+        ctx.voice_state.prefetch()
+        await ctx.respond('Moved {} to position {}'.format(str(song), min(max(position, 1), len(ctx.voice_state.songs))))
+
     @commands.slash_command(name='loop')
     async def _loop(self, ctx: discord.ApplicationContext):
         """Loops the currently playing song.
@@ -560,8 +4108,15 @@ class Music(commands.Cog):
             await ctx.respond("unlooping playlist")
 
 
+    async def suggest(self, ctx: discord.AutocompleteContext):
+        """Offers the tracks matching what was typed into `search` so far."""
+
+        return await YTDLSource.suggestions.suggest(ctx.value, user_id=ctx.interaction.user.id,
+                                                    guild_id=ctx.interaction.guild_id, loop=self.bot.loop)
+
     @commands.slash_command(name='play',description='plays a song')
-    async def _play(self, ctx: discord.ApplicationContext, *, search: str):
+    async def _play(self, ctx: discord.ApplicationContext, *,
+                    search: discord.Option(str, 'Song name or URL', autocomplete=suggest)):
         """Plays a song.
         If there are songs in the queue, this will be queued until the
         other songs finished playing.
@@ -569,7 +4124,7 @@ class Music(commands.Cog):
         A list of these sites can be found here: https://rg3.github.io/youtube-dl/supportedsites.html
         """
 
-        if not ctx.voice_state.voice or not ctx.voice_state.is_in_channel():
+        if not ctx.voice_state.voice or not ctx.voice_state.voice.is_connected():
             await ctx.invoke(self._join)
         
 
@@ -580,15 +4135,28 @@ class Music(commands.Cog):
             
         async with ctx.typing():
             try:
-                source = await YTDLSource.create_source(ctx, search, loop=self.bot.loop)
+                title, entries = await YTDLSource.resolve_all(search, guild_id=ctx.guild.id, loop=self.bot.loop)
                 
             except YTDLError as e:
                 await ctx.respond('An error occurred while processing this request: {}'.format(str(e)))
             else:
-                song = Song(source)
+                enqueued = 0
+                for info in entries:
+                    song = Song(ctx.author, ctx.channel, info)
+                    if ctx.voice_state.songs.skip_duplicates and ctx.voice_state.songs.find(song.url) is not None:
+                        continue
+                    await ctx.voice_state.enqueue(song)
+                    enqueued += 1
 
-                await ctx.voice_state.songs.put(song)
-                await ctx.respond('Enqueued {}'.format(str(source)))
+                if title is None:
+                    if enqueued:
+                        await ctx.respond('Enqueued {}'.format(str(song)))
+                    else:
+                        await ctx.respond('{} is already in the queue.'.format(str(song)))
+                else:
+                    skipped = len(entries) - enqueued
+                    await ctx.respond('Enqueued {} tracks from **{}**{}'.format(
+                        enqueued, title, ' ({} already queued)'.format(skipped) if skipped else ''))
                 
                 
 
@@ -612,16 +4180,108 @@ intents.typing = True
 intents.presences = True
 intents.messages = True
 intents.message_content = True
-bot = discord.Bot(command_prefix=commands.when_mentioned_or("!"), description='Yet another music bot.',intents=intents)
 
 
+def create_bot(**options):
+    """Creates the bot, sharded over ``shard_ids`` if given."""
 
-@bot.event
-async def on_ready():
-    print('Logged in as:\n{0.user.name}\n{0.user.id}'.format(bot))
-    
-load_dotenv("Token.env")    
-bot.add_cog(Music(bot))
-TOKEN = os.getenv('DISCORD_TOKEN')
+    cls = discord.AutoShardedBot if options.get('shard_ids') is not None else discord.Bot
+    bot = cls(command_prefix=commands.when_mentioned_or("!"), description='Yet another music bot.', intents=intents,
+              **options)
+
+    @bot.event
+    async def on_ready():
+        print('Logged in as:\n{0.user.name}\n{0.user.id}'.format(bot))
+
+    return bot
+
+
+def configure(worker: int = None, workers: int = 1):
+    """Sets up the shared resources from the environment, returns the options for the Music cog.
+
+    ``worker`` is the index of the shard process when sharded, global
+    budgets are split evenly between the ``workers`` processes.
+    """
+
+    YTDLSource.executor = ExtractionExecutor(int(os.getenv('EXTRACTION_WORKERS', 4)),
+                                             int(os.getenv('EXTRACTION_GUILD_LIMIT', 2)),
+                                             use_processes=os.getenv('EXTRACTION_PROCESSES') == '1')
+    # Every process keeps its own audio cache directory, their byte accounting isn't shared.
+    directory = 'audio_cache' if worker is None else os.path.join('audio_cache', 'shard{}'.format(worker))
+    YTDLSource.audio_cache = AudioCache(directory, max_bytes=int(os.getenv('AUDIO_CACHE_MB', 0)) * 1024 * 1024 // workers)
+    YTDLSource.shared_streams = SharedStreamHub(enabled=os.getenv('SHARED_STREAMS') == '1')
+    YTDLSource.ffmpeg_limiter = FFmpegLimiter(int(os.getenv('MAX_FFMPEG_PROCESSES', 0)) // workers)
+    NowPlaying.progress_interval = float(os.getenv('NOW_PLAYING_PROGRESS', 0))
+    TrackMixer.crossfade = float(os.getenv('CROSSFADE', 0))
+    SongQueue.skip_duplicates = os.getenv('SKIP_DUPLICATES') == '1'
+    YTDLSource.suggestions = SearchSuggestions(ttl=float(os.getenv('SUGGESTION_TTL', 120)),
+                                               workers=int(os.getenv('SUGGESTION_WORKERS', 2)))
+
+    metrics_port = int(os.getenv('METRICS_PORT', 0))
+    if metrics_port and worker is not None:
+        metrics_port += worker
+    return {
+        'idle_timeout': int(os.getenv('IDLE_TIMEOUT', 180)),
+        'empty_timeout': int(os.getenv('EMPTY_CHANNEL_TIMEOUT', 60)),
+        'metrics_port': metrics_port,
+    }
+
+
+def run_shard(worker: int, workers: int, shard_ids: list, shard_count: int, address: tuple, authkey: bytes):
+    """Entry point of a shard process, runs the bot on ``shard_ids`` only."""
+
+    load_dotenv("Token.env")
+    options = configure(worker, workers)
+    # Application commands are global, one process registering them is enough.
+    bot = create_bot(shard_ids=shard_ids, shard_count=shard_count, auto_sync_commands=worker == 0)
+    shards = ShardClient(worker, address, authkey, bot.loop)
+    YTDLSource.cache = SharedExtractionCache(shards)
+    bot.add_cog(Music(bot, shards=shards, **options))
+    bot.run(os.getenv('DISCORD_TOKEN'))
+
+
+def run_sharded(workers: int, shard_count: int):
+    """Runs the bot in ``workers`` shard processes under a :class:`ShardCoordinator`, restarting any that exit."""
+
+    coordinator = ShardCoordinator()
+    coordinator.start()
+    context = multiprocessing.get_context('spawn')
+    shard_ids = [list(range(shard_count))[worker::workers] for worker in range(workers)]
+
+    def spawn(worker):
+        process = context.Process(target=run_shard, name='shard{}'.format(worker),
+                                  args=(worker, workers, shard_ids[worker], shard_count, coordinator.address,
+                                        coordinator.authkey))
+        process.start()
+        return process
+
+    processes = {worker: spawn(worker) for worker in range(workers)}
+    try:
+        while True:
+            multiprocessing.connection.wait([process.sentinel for process in processes.values()])
+            for worker, process in list(processes.items()):
+                if not process.is_alive():
+                    print('Shard process {} exited with code {}, restarting it'.format(worker, process.exitcode))
+                    # Identifying too often gets the token rate limited.
+                    time.sleep(5)
+                    processes[worker] = spawn(worker)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes.values():
+            process.terminate()
+        coordinator.close()
+
+
+if __name__ == '__main__':
+    # Guarded so process-pool extraction workers can import this module without starting the bot.
+    load_dotenv("Token.env")
+    workers = int(os.getenv('SHARD_PROCESSES', 1))
+    if workers > 1:
+        run_sharded(workers, int(os.getenv('SHARD_COUNT', workers)))
+    else:
+        bot = create_bot()
+        bot.add_cog(Music(bot, **configure()))
+        TOKEN = os.getenv('DISCORD_TOKEN')
 
-bot.run(TOKEN)
+        bot.run(TOKEN)